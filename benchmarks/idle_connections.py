@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Time new whois connections while the server holds many idle keep-alive
+connections.
+
+A server from this tree is started on a local port. Then, for each
+number of idle connections, the median time of connecting, sending
+"--version" and reading the reply is measured. Run it on two revisions
+to compare them.
+"""
+from optparse import OptionParser
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SERVER = """
+import sys
+sys.path.insert(0, {root!r})
+from twisted.internet import reactor
+from ripestat.server import StatTextFactory
+reactor.listenTCP({port}, StatTextFactory("http://127.0.0.1:1/"),
+                  backlog=2048, interface="127.0.0.1")
+reactor.run()
+"""
+
+
+def raise_file_limit(count):
+    """
+    Allow this process (and the server it starts) to open `count` files.
+    """
+    hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+    if hard != resource.RLIM_INFINITY:
+        count = min(count, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (count, hard))
+
+
+def wait_for_server(port, timeout=10):
+    """
+    Wait until the server accepts connections.
+    """
+    end_time = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except socket.error:
+            if time.time() > end_time:
+                raise
+            time.sleep(0.1)
+
+
+def probe(port, count):
+    """
+    Return the median time in milliseconds of `count` round trips on new
+    connections.
+    """
+    timings = []
+    for _ in range(count):
+        start = time.time()
+        connection = socket.create_connection(("127.0.0.1", port))
+        connection.sendall(" --version\n")
+        connection.recv(100)
+        timings.append(time.time() - start)
+        connection.close()
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def main(params):
+    parser = OptionParser(usage="%prog [-p PORT] [IDLE...]")
+    parser.add_option("-p", "--port", type="int", default=4343)
+    parser.add_option("-n", "--probes", type="int", default=50,
+                      help="round trips to time per step")
+    options, args = parser.parse_args(params)
+    steps = [int(arg) for arg in args] or [10, 100, 1000, 5000, 10000]
+
+    raise_file_limit(max(steps) + 1000)
+    server = subprocess.Popen([sys.executable, "-c", SERVER.format(
+        root=ROOT, port=options.port)])
+    idle = []
+    try:
+        wait_for_server(options.port)
+        for target in steps:
+            while len(idle) < target:
+                connection = socket.create_connection(
+                    ("127.0.0.1", options.port))
+                connection.sendall(" -k\n")
+                idle.append(connection)
+            time.sleep(1)
+            print "{0:6d} idle connections: median {1:.2f} ms".format(
+                target, probe(options.port, options.probes))
+    finally:
+        for connection in idle:
+            connection.close()
+        server.terminate()
+        server.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
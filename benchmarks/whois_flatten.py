@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Time the flattening and formatting of nested data by WhoisSerializer.
+
+Run it on two revisions to compare them, e.g.:
+
+    python benchmarks/whois_flatten.py
+    git checkout HEAD~1 && python benchmarks/whois_flatten.py
+"""
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ripestat.whois import WhoisSerializer
+
+
+def wide_fixture():
+    """
+    A routing-history-like response: 50 origins with 200 prefixes each.
+    """
+    return {"by_origin": [{
+        "origin": str(origin),
+        "prefixes": [{
+            "prefix": u"10.{0}.{1}.0/24".format(origin, prefix),
+            "timelines": [{"starttime": u"2012-01-01T00:00:00",
+                           "endtime": u"2013-01-01T00:00:00"}] * 3,
+        } for prefix in range(200)],
+    } for origin in range(50)]}
+
+
+def deep_fixture():
+    """
+    Dicts nested 30 deep around 20000 leaves.
+    """
+    data = [u"leaf"] * 20000
+    for level in range(30):
+        data = {"level{0}".format(level): data, "x": 1}
+    return data
+
+
+def best_time(func, repeat):
+    """
+    Return the shortest of `repeat` timings of func() in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main(params):
+    parser = OptionParser(usage="%prog [-r REPEAT]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="number of runs of each timing (the best is "
+                      "shown)")
+    options, _ = parser.parse_args(params)
+
+    serializer = WhoisSerializer()
+    for name, fixture in (("wide routing-history", wide_fixture()),
+                          ("30-deep dicts", deep_fixture())):
+        items = [("x", fixture)]
+        flatten = best_time(lambda: serializer.get_items(items),
+                            options.repeat)
+        dumps = best_time(lambda: serializer.dumps(items), options.repeat)
+        print "{0:<22} flattening {1:.3f}s  dumps {2:.3f}s".format(
+            name, flatten, dumps)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,100 @@
+"""
+Structured access logging that stays cheap under high query rates.
+"""
+from Queue import Queue, Empty, Full
+import random
+import threading
+import time
+
+from ripestat.api import json
+
+
+class AccessLog(object):
+    """
+    Write access log records as lines of JSON from a background thread.
+
+    log() only filters the record and puts it on a bounded queue, so the
+    formatting and I/O never happen on the calling thread. Records from
+    clients in `exclude` are ignored, and only a `sample_rate` fraction of
+    the others is kept. If the writer falls behind, records are dropped
+    rather than queued without bound, and the number of dropped records is
+    included in the next batch.
+
+    `write` is called from the background thread with a list of lines once
+    `batch_size` records are queued or `flush_interval` seconds have passed.
+
+    Usage:
+        access_log = AccessLog(open("access.log", "a").writelines)
+        access_log.start()
+        access_log.log({"client": "192.0.2.1", "query": "as3333"})
+        access_log.stop()
+    """
+    def __init__(self, write, sample_rate=1.0, exclude=(), max_queued=10000,
+                 batch_size=100, flush_interval=1.0):
+        self.write = write
+        self.sample_rate = sample_rate
+        self.exclude = frozenset(exclude)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue(max_queued)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.thread = None
+
+    def log(self, record):
+        """
+        Queue a record (a dict with at least a 'client' key) for writing.
+        """
+        if record["client"] in self.exclude:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        record["time"] = time.time()
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def start(self):
+        """
+        Start the background writer.
+        """
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Write the queued records and stop the background writer.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """
+        Write batches of records until stop() is called.
+        """
+        running = True
+        while running:
+            batch = []
+            end_time = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(
+                        timeout=max(0, end_time - time.time()))
+                except Empty:
+                    break
+                if record is None:
+                    running = False
+                    break
+                batch.append(record)
+            with self.dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                batch.append({"time": time.time(), "dropped": dropped})
+            if batch:
+                self.write([json.dumps(item, default=unicode) + "\n"
+                            for item in batch])
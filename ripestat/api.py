@@ -1,5 +1,9 @@
 from cookielib import CookieJar, Cookie
+import logging
+import socket
 import sys
+import threading
+import time
 import urllib
 import urllib2
 try:
@@ -8,6 +12,11 @@ except ImportError:
     import json
 
 from ripestat import __version__
+from ripestat.resources import InvalidResource, query_key
+from ripestat.upstream import start_thread
+
+
+LOG = logging.getLogger(__name__)
 
 
 class StatAPI(object):
@@ -29,6 +38,13 @@ class StatAPI(object):
 
     RIPE_ACCESS = "https://access.ripe.net"
     DATA_API = "https://stat.ripe.net/data/"
+    # Seconds to wait for the data API before giving up on a request
+    DEFAULT_TIMEOUT = 60
+    # Client errors that depend on the load rather than the query
+    UNCACHEABLE_ERRORS = frozenset([408, 429])
+    # Data calls whose responses depend on who is asking (e.g. the client
+    # address in X-Forwarded-For) rather than only on the query
+    CALLER_CALLS = frozenset(["whats-my-ip"])
 
     class Error(Exception):
         """
@@ -40,8 +56,32 @@ class StatAPI(object):
         Raised when an unsuccesful response is received from the server.
         """
         def __init__(self, http_error):
-            self.response = json.loads(http_error.read())
-            self.status_code = http_error.code
+            body = http_error.read()
+            try:
+                response = json.loads(body)
+            except ValueError:
+                # Proxies and overloaded servers don't always answer in JSON
+                response = {"messages": [
+                    ["error", "HTTP error {0}".format(http_error.code)]]}
+            self.set_response(http_error.code, response)
+
+        @classmethod
+        def from_response(cls, status_code, response):
+            """
+            Create the error for a previously received status code and
+            (decoded) response.
+            """
+            error = cls.__new__(cls)
+            error.set_response(status_code, response)
+            return error
+
+        def set_response(self, status_code, response):
+            """
+            Set the status code and response, using the error messages of
+            the response as the exception arguments.
+            """
+            self.status_code = status_code
+            self.response = response
             errors = [m[1] for m in self.response["messages"] if m[0] ==
                 "error"]
             super(StatAPI.ServerError, self).__init__(*errors)
@@ -55,9 +95,105 @@ class StatAPI(object):
             StatAPI.Error.__init__(self, "expected version {1}.x of the '{0}' "
                 "data call; found {2}".format(call, requested, actual))
 
-    def __init__(self, caller_id, base_url=DATA_API, headers=None, token=None):
+    class BusyError(Error):
+        """
+        Raised when no upstream request slot became free in time.
+        """
+        def __init__(self):
+            StatAPI.Error.__init__(self, "too many concurrent requests to "
+                                   "the data API, please try again later")
+
+    class TimeoutError(Error):
+        """
+        Raised when the data API doesn't respond in time.
+        """
+        def __init__(self, timeout):
+            StatAPI.Error.__init__(self, "no response from the data API "
+                                   "after {0} seconds".format(timeout))
+
+    class ConnectionError(Error):
+        """
+        Raised when the data API can't be reached.
+        """
+        def __init__(self, reason):
+            StatAPI.Error.__init__(self, "unable to connect to the data API: "
+                                   "{0}".format(reason))
+
+    class CircuitOpenError(Error):
+        """
+        Raised instead of calling a data call that has been failing
+        repeatedly.
+        """
+        def __init__(self, call):
+            StatAPI.Error.__init__(self, "the '{0}' data call is temporarily "
+                                   "unavailable, please try again later"
+                                   .format(call))
+
+    class BudgetError(Error):
+        """
+        Raised instead of sending more than `upstream_budget` requests to
+        the data API.
+        """
+        def __init__(self):
+            StatAPI.Error.__init__(self, "the budget of data API requests "
+                                   "has been used up")
+
+    class SnapshotMissError(Error):
+        """
+        Raised when a data call that is answered from a snapshot has no
+        response for the requested resource.
+        """
+        def __init__(self, call, resource):
+            StatAPI.Error.__init__(self, "no '{0}' data for {1} in the "
+                                   "snapshot".format(call, resource))
+
+    def __init__(self, caller_id, base_url=DATA_API, headers=None, token=None,
+                 upstream_limit=None, timeout=DEFAULT_TIMEOUT,
+                 retry_policy=None, circuit_breaker=None, cache=None,
+                 snapshot=None, error_cache=None):
         self.base_url = base_url
 
+        # An optional snapshot.Snapshot that answers the data calls it
+        # contains locally
+        self.snapshot = snapshot
+
+        # An optional cache.CacheBackend that can be shared between
+        # instances
+        self.cache = cache
+        # Cached responses that expire sooner than this many seconds are
+        # fetched again (used to refresh entries before they expire)
+        self.cache_min_ttl = 0
+        # An optional cache.CacheBackend for client (4xx) errors, so that
+        # repeated bad queries aren't sent to the data API. It is kept apart
+        # from the response cache so that errors can't evict responses.
+        self.error_cache = error_cache
+        # The number of requests that actually went to the data API
+        self.upstream_requests = 0
+        # The number of requests that were answered from the cache
+        self.cache_hits = 0
+        # The number of requests that were answered with stale responses
+        # from the cache
+        self.stale_hits = 0
+        # The counters are updated by several threads (widgets and
+        # background refreshes)
+        self.counts_lock = threading.Lock()
+        # Maximum number of requests to send to the data API (None is
+        # unlimited)
+        self.upstream_budget = None
+
+        # An optional upstream.CircuitBreaker, keyed on data call names
+        self.circuit_breaker = circuit_breaker
+
+        # An optional upstream.RetryPolicy for retrying and hedging requests
+        self.retry_policy = retry_policy
+
+        # Socket timeout for each data API request (None waits for ever)
+        self.timeout = timeout
+
+        # An optional limits.ConcurrencyLimit that can be shared between
+        # instances to cap the number of simultaneous upstream requests
+        self.upstream_limit = upstream_limit
+
         self.cookiejar = StatCookieJar(token)
 
         self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(
@@ -90,16 +226,150 @@ class StatAPI(object):
         requesting a specific version.
         """
         json_response = self.get_response("%s/data.json" % call, query)
+        return self.decode_data(call, json_response, version)
+
+    def decode_data(self, call, json_response, version=None):
+        """
+        Deserialize the body of a data call response, checking the version
+        if one is given.
+
+        Stale responses from the cache have a 'stale' flag in their metadata.
+        """
         response = json.loads(json_response)
+        if isinstance(json_response, StaleResponse):
+            response["stale"] = True
         if version is not None:
             maj_version, min_version = response["version"].split(".", 2)
             if int(maj_version) != version:
                 raise self.VersionError(call, version, response["version"])
-        return DataResponse(response)
+        response = DataResponse(response)
+        if isinstance(json_response, CachedResponse):
+            response.expires = json_response.expires
+        return response
 
     def get_response(self, url=None, query=None):
         """
         Return the (serialized) body of a raw data response.
+
+        Bodies that are cached are returned as a CachedResponse, which
+        knows when the cache entry expires. If the cache holds a response
+        that expired less than its `stale_ttl` ago, it is returned as a
+        StaleResponse right away while a fresh one is fetched in the
+        background. A stale response is also returned if the data API is
+        unavailable.
+        """
+        # Requests are tracked per data call, e.g. 'routing-history'
+        call = (url or "").split("/", 1)[0]
+        if self.snapshot and call in self.snapshot.call_numbers:
+            return self.get_snapshot_response(call, query)
+
+        url = self.get_url(url, query)
+        key = self.cache_key(call, url)
+
+        stale = None
+        entry = None
+        if self.cache and key is not None:
+            entry = self.cache.read(key)
+            if entry is not None:
+                expires, response = entry
+                remaining = expires - time.time()
+                if remaining > 0 and remaining >= self.cache_min_ttl:
+                    self.increment("cache_hits")
+                    return CachedResponse(response, expires)
+                if remaining > -self.cache.stale_ttl:
+                    stale = StaleResponse(response, expires)
+                # Refreshing cache entries ahead of time (cache_min_ttl) is
+                # done in the foreground
+                if stale is not None and remaining <= 0 and \
+                        not self.cache_min_ttl:
+                    self.increment("stale_hits")
+                    if self.cache.claim_refresh(key):
+                        start_thread(self.refresh_response, call, url, key)
+                    return stale
+        if entry is None and self.error_cache and key is not None:
+            error = self.error_cache.get(key)
+            if error is not None:
+                self.increment("cache_hits")
+                error = json.loads(error)
+                raise self.ServerError.from_response(
+                    error["status_code"], error["response"])
+
+        try:
+            return self.fetch_response(call, url, key)
+        except self.Error as exc:
+            if stale is None or not (self.is_upstream_failure(exc) or
+                                     isinstance(exc, (self.BusyError,
+                                                      self.CircuitOpenError))):
+                raise
+            LOG.info("serving a stale response for %s: %s", url, exc)
+            self.increment("stale_hits")
+            return stale
+
+    def fetch_response(self, call, url, key=None):
+        """
+        Fetch the body of a response for a full URL from the data API and
+        cache it under `key` (None doesn't cache it, see cache_key()).
+        """
+        with self.counts_lock:
+            if self.upstream_budget is not None and \
+                    self.upstream_requests >= self.upstream_budget:
+                raise self.BudgetError()
+            self.upstream_requests += 1
+        breaker = self.circuit_breaker
+        if breaker and not breaker.allow(call):
+            raise self.CircuitOpenError(call)
+        start = time.time()
+        try:
+            if self.retry_policy:
+                response = self.retry_policy.call(
+                    self.fetch, call, self.is_retryable, url)
+            else:
+                response = self.fetch(url)
+        except self.BusyError:
+            if breaker:
+                breaker.abandon(call)
+            raise
+        except Exception as exc:
+            if breaker:
+                breaker.record(call, time.time() - start,
+                               failed=self.is_upstream_failure(exc))
+            if self.error_cache and key is not None and \
+                    self.is_cacheable_error(exc):
+                self.error_cache.set(key, json.dumps({
+                    "status_code": exc.status_code,
+                    "response": exc.response,
+                }))
+            raise
+        if breaker:
+            breaker.record(call, time.time() - start)
+        if self.cache and key is not None:
+            expires = time.time() + self.cache.ttl
+            if self.cache.set(key, response):
+                return CachedResponse(response, expires)
+        return response
+
+    def refresh_response(self, call, url, key):
+        """
+        Replace a stale cache entry with a fresh response, keeping the stale
+        one if that fails.
+        """
+        try:
+            self.fetch_response(call, url, key)
+        except Exception as exc:
+            LOG.info("refreshing %s failed: %s", url, exc)
+        finally:
+            self.cache.release_refresh(key)
+
+    def increment(self, counter):
+        """
+        Add one to the counter attribute with the given name.
+        """
+        with self.counts_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_url(self, url=None, query=None):
+        """
+        Return the full URL for a path relative to the base URL and a query.
         """
         if url:
             url = "%s/%s" % (self.base_url.rstrip("/"), url)
@@ -108,14 +378,104 @@ class StatAPI(object):
         if not url.startswith("http"):
             url = "https://" + url
         if query:
+            if isinstance(query, dict):
+                # Sorting the parameters gives a stable cache key
+                query = sorted(query.items())
             url += "?" + urllib.urlencode(query)
+        return url
+
+    def cache_key(self, call, url):
+        """
+        Return the key of the cached response for a full URL, or None if the
+        response mustn't be cached.
+
+        The cache may be shared with other instances, so responses that
+        depend on the caller are kept apart: those of logged in users aren't
+        cached at all, and those of CALLER_CALLS are cached per set of
+        headers (which carry the client address in the server).
+        """
+        if self.cookiejar.token:
+            return None
+        if call in self.CALLER_CALLS and self.headers:
+            return url + " " + urllib.urlencode(sorted(self.headers))
+        return url
+
+    def get_data_expiry(self, call, query=None):
+        """
+        Return the time at which the cached response for a data call
+        expires, or None if it isn't cached.
+        """
+        key = self.cache_key(call, self.get_url("%s/data.json" % call, query))
+        if not self.cache or key is None:
+            return None
+        return self.cache.expires(key)
 
+    def get_snapshot_response(self, call, query):
+        """
+        Return the body of a data call response from the snapshot.
+        """
+        resource = dict(query or {}).get("resource")
+        response = None
+        if resource:
+            try:
+                response = self.snapshot.get_response(call, resource)
+            except InvalidResource:
+                pass
+        if response is None:
+            raise self.SnapshotMissError(call, resource)
+        return response
+
+    def fetch(self, url):
+        """
+        Carry out a single request for a full URL and return the decoded
+        body.
+        """
+        if self.upstream_limit and not self.upstream_limit.acquire():
+            raise self.BusyError()
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs["timeout"] = self.timeout
         try:
-            response = self.open(url).read()
+            response = self.open(url, **kwargs).read()
         except urllib2.HTTPError as exc:
             raise self.ServerError(exc)
+        except socket.timeout:
+            raise self.TimeoutError(self.timeout)
+        except urllib2.URLError as exc:
+            if isinstance(exc.reason, socket.timeout):
+                raise self.TimeoutError(self.timeout)
+            raise self.ConnectionError(exc.reason)
+        except socket.error as exc:
+            raise self.ConnectionError(exc)
+        finally:
+            if self.upstream_limit:
+                self.upstream_limit.release()
         return response.decode("UTF-8")
 
+    def is_retryable(self, exc):
+        """
+        Return True if a failed request is safe and worthwhile to repeat.
+        """
+        if isinstance(exc, self.ServerError):
+            return exc.status_code >= 500
+        return isinstance(exc, self.ConnectionError)
+
+    def is_cacheable_error(self, exc):
+        """
+        Return True if a failed request would fail the same way if it were
+        repeated soon, i.e. the query itself is bad.
+        """
+        return isinstance(exc, self.ServerError) and \
+            400 <= exc.status_code < 500 and \
+            exc.status_code not in self.UNCACHEABLE_ERRORS
+
+    def is_upstream_failure(self, exc):
+        """
+        Return True if a failed request indicates that the data call itself
+        is unhealthy (as opposed to a bad query).
+        """
+        return self.is_retryable(exc) or isinstance(exc, self.TimeoutError)
+
     def open(self, url, *args, **kwargs):
         """
         Wrapper around the urllib2 opener that sets a User-Agent header
@@ -146,6 +506,108 @@ class StatAPI(object):
         return "Welcome," in response.read()
 
 
+class RequestMemo(object):
+    """
+    Wrapper around a StatAPI that makes the widgets of a single request share
+    their data calls.
+
+    When several widgets need the same call with the same query, only the
+    first one goes to the API; the others wait for its response. Each caller
+    decodes its own copy, so widgets are free to modify the data they get.
+    All other attributes are looked up on the wrapped StatAPI.
+    """
+    def __init__(self, api):
+        self.api = api
+        # (call, query) => MemoEntry
+        self.entries = {}
+        self.lock = threading.Lock()
+        # The number of data calls that were answered from the memo
+        self.saved = 0
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def get_data(self, call, query=None, version=None):
+        """
+        Like StatAPI.get_data, but only fetches each response once.
+        """
+        key = (call, query_key(query))
+        with self.lock:
+            entry = self.entries.get(key)
+            fetch = entry is None
+            if fetch:
+                entry = self.entries[key] = MemoEntry()
+            else:
+                self.saved += 1
+
+        if fetch:
+            try:
+                entry.response = self.api.get_response(
+                    "%s/data.json" % call, query)
+            except Exception as exc:
+                entry.error = exc
+            finally:
+                entry.done.set()
+        else:
+            entry.done.wait()
+
+        if entry.error is not None:
+            raise entry.error
+        return self.api.decode_data(call, entry.response, version)
+
+
+class CallRecorder(object):
+    """
+    Wrapper around a StatAPI (or RequestMemo) that records the data calls
+    made through it, and their latency if given a scheduling.CostTracker.
+
+    All other attributes are looked up on the wrapped object.
+    """
+    def __init__(self, api, costs=None):
+        self.api = api
+        self.costs = costs
+        # (call, query) tuples in the order in which they were made
+        self.calls = []
+        # The expiry times of the cache entries of the responses, in the
+        # same order (None for responses that aren't cached)
+        self.expiries = []
+        # Set if any of the responses was stale
+        self.stale = False
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def get_data(self, call, query=None, version=None):
+        """
+        Like StatAPI.get_data, but remembers the call and query.
+        """
+        self.calls.append((call, query))
+        start = time.time()
+        expires = None
+        try:
+            response = self.api.get_data(call, query, version)
+            expires = response.expires
+        finally:
+            self.expiries.append(expires)
+            if self.costs is not None:
+                self.costs.record(call, time.time() - start)
+        if response.meta.get("stale"):
+            self.stale = True
+        return response
+
+
+class MemoEntry(object):
+    """
+    A response, or the error raised instead, that is shared via RequestMemo.
+    """
+    __slots__ = "done", "response", "error"
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
 class StatCookieJar(CookieJar):
     """
     CookieJar that remembers and reinserts RIPE NCC Access cookies.
@@ -206,6 +668,24 @@ class StatCookieJar(CookieJar):
             return ""
 
 
+class CachedResponse(unicode):
+    """
+    The body of a response that is in the cache, along with the time at
+    which its cache entry expires.
+    """
+    def __new__(cls, body, expires):
+        self = unicode.__new__(cls, body)
+        self.expires = expires
+        return self
+
+
+class StaleResponse(CachedResponse):
+    """
+    The body of a cached response that has expired, returned by
+    StatAPI.get_response when no fresh response is available.
+    """
+
+
 class DataResponse(dict):
     """
     The response from a data API call.
@@ -218,3 +698,6 @@ class DataResponse(dict):
         self.update(response["data"])
         del response["data"]
         self.meta = response
+        # The time at which the cached response expires (see
+        # CachedResponse), or None if it isn't cached
+        self.expires = None
@@ -0,0 +1,567 @@
+"""
+Caching of data API responses.
+
+StatAPI can use any CacheBackend, e.g. a ResponseCache for a single process,
+a CompressedResponseCache to keep more responses in the memory of a single
+process, a SharedResponseCache for the processes on a host or a
+MemcachedCache for several hosts.
+"""
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from Queue import Queue, Empty, Full
+import errno
+import hashlib
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import zlib
+
+from ripestat.upstream import thread_cpu_time
+
+
+LOG = logging.getLogger(__name__)
+
+
+class CacheBackend(object):
+    """
+    The interface of the response caches.
+
+    Keys and bodies are (unicode) strings. Subclasses must implement read()
+    and set(), and must be thread-safe.
+
+    Entries stay fresh for `ttl` seconds by default, after which they are
+    kept for another `stale_ttl` seconds so that StatAPI can serve them while
+    it fetches a new response, or if fetching one fails.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, ttl=300, stale_ttl=0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # Keys of the stale entries that are being refreshed
+        self.refreshing = set()
+        self.refresh_lock = threading.Lock()
+
+    @abstractmethod
+    def read(self, key):
+        """
+        Return the (expiry time, body) of the entry for `key`, or None.
+
+        Entries that expired less than `stale_ttl` seconds ago must still be
+        returned.
+        """
+
+    @abstractmethod
+    def set(self, key, body, ttl=None):
+        """
+        Store a body for `key`, for `ttl` seconds instead of the default if
+        given, and return True if it was stored.
+        """
+
+    def get(self, key, min_ttl=0):
+        """
+        Return the cached body for `key`, or None if there is no entry that
+        will stay fresh for at least another `min_ttl` seconds.
+        """
+        entry = self.read(key)
+        if entry is None:
+            return None
+        expires, body = entry
+        remaining = expires - time.time()
+        if remaining <= 0 or remaining < min_ttl:
+            return None
+        return body
+
+    def expires(self, key):
+        """
+        Return the time at which the entry for `key` expires, or None.
+        """
+        entry = self.read(key)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def stats(self):
+        """
+        Return a dict of counters for logging.
+        """
+        return {}
+
+    def claim_refresh(self, key):
+        """
+        Return True if the caller should refresh the stale entry for `key`,
+        i.e. no other thread is already doing so. The caller must call
+        release_refresh() once it is done.
+        """
+        with self.refresh_lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+            return True
+
+    def release_refresh(self, key):
+        """
+        Allow the entry for `key` to be refreshed again.
+        """
+        with self.refresh_lock:
+            self.refreshing.discard(key)
+
+
+class ResponseCache(CacheBackend):
+    """
+    Thread-safe in-memory cache of serialized data API responses.
+
+    Entries expire `ttl` seconds after they are stored and are dropped once
+    they have been stale for `stale_ttl` seconds. The least recently used
+    entries are evicted once there are more than `max_entries`.
+    """
+    def __init__(self, ttl=300, max_entries=10000, stale_ttl=0):
+        CacheBackend.__init__(self, ttl, stale_ttl)
+        self.max_entries = max_entries
+        # key => (expiry time, body), in least recently used order
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read(self, key):
+        """
+        Return the (expiry time, body) of the entry for `key` and mark it as
+        recently used, or return None.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] + self.stale_ttl <= time.time():
+                return None
+            self.entries[key] = entry
+            return entry
+
+    def set(self, key, body, ttl=None):
+        """
+        Store a body for `key`, for `ttl` seconds instead of the default if
+        given, and return True if it was stored.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, body)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return True
+
+
+class CompressedResponseCache(CacheBackend):
+    """
+    Thread-safe in-memory cache of serialized data API responses that keeps
+    them compressed with zlib, which shrinks typical JSON responses several
+    times over.
+
+    Bodies are only decompressed when they are read. The least recently used
+    entries are evicted once the compressed bodies take up more than
+    `max_bytes`. Entries expire like those of ResponseCache.
+
+    Usage:
+        cache = CompressedResponseCache(ttl=300, max_bytes=256 * 2 ** 20)
+        api = StatAPI("my-script", cache=cache)
+    """
+    def __init__(self, ttl=300, max_bytes=2 ** 28, stale_ttl=0,
+                 compress_level=6):
+        CacheBackend.__init__(self, ttl, stale_ttl)
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        # key => (expiry time, compressed body, uncompressed size), in least
+        # recently used order
+        self.entries = OrderedDict()
+        # The total compressed and uncompressed sizes of the bodies
+        self.size = 0
+        self.raw_size = 0
+        self.hits = 0
+        # CPU time spent decompressing, which unlike the wall clock time
+        # doesn't include waiting for other threads
+        self.decode_time = 0.0
+        self.lock = threading.Lock()
+
+    def read(self, key):
+        """
+        Return the (expiry time, body) of the entry for `key` and mark it as
+        recently used, or return None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] + self.stale_ttl <= time.time():
+                self.remove(key)
+                return None
+            del self.entries[key]
+            self.entries[key] = entry
+        start = thread_cpu_time()
+        body = zlib.decompress(entry[1]).decode("utf-8")
+        elapsed = thread_cpu_time() - start
+        with self.lock:
+            self.hits += 1
+            self.decode_time += elapsed
+        return entry[0], body
+
+    def expires(self, key):
+        """
+        Return the time at which the entry for `key` expires, or None,
+        without decompressing it.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def set(self, key, body, ttl=None):
+        """
+        Store a body for `key`, for `ttl` seconds instead of the default if
+        given, and return True if it was stored.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        raw = body.encode("utf-8")
+        data = zlib.compress(raw, self.compress_level)
+        with self.lock:
+            self.remove(key)
+            if len(data) > self.max_bytes:
+                # It would evict every other entry and then itself
+                return False
+            self.entries[key] = (time.time() + ttl, data, len(raw))
+            self.size += len(data)
+            self.raw_size += len(raw)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+        return True
+
+    def remove(self, key):
+        """
+        Remove the entry for `key` if there is one. The lock must be held.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+            self.raw_size -= entry[2]
+
+    def stats(self):
+        """
+        Return the number of entries, their compressed size, the memory
+        saved by compressing them and the average CPU time spent
+        decompressing a body.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "saved-bytes": self.raw_size - self.size,
+                "hits": self.hits,
+                "decode-ms-per-hit": round(
+                    self.decode_time * 1000 / max(1, self.hits), 3),
+            }
+
+
+class SharedResponseCache(CacheBackend):
+    """
+    Cache of serialized data API responses in a directory, so that it can be
+    shared between processes on the same host (e.g. the workers of a
+    pre-forked server). Putting the directory on a tmpfs such as /dev/shm
+    keeps it in memory.
+
+    Each entry is a file named after a hash of its key, holding the expiry
+    time on the first line and the body after it. Entries are written to a
+    temporary file and renamed into place, so readers never see partial
+    entries and no locking is needed. Once there are more than `max_entries`
+    files, the least recently written ones are removed.
+    """
+    # Number of writes between checks of the number of entries
+    prune_interval = 100
+
+    def __init__(self, path, ttl=300, max_entries=10000, stale_ttl=0):
+        CacheBackend.__init__(self, ttl, stale_ttl)
+        self.path = path
+        self.max_entries = max_entries
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def get_filename(self, key):
+        """
+        Return the path of the file for `key`.
+        """
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def read(self, key):
+        """
+        Return the (expiry time, body) of the entry for `key`, or None.
+        """
+        try:
+            with open(self.get_filename(key), "rb") as handle:
+                data = handle.read()
+        except IOError:
+            return None
+        expires, _, body = data.partition("\n")
+        try:
+            return float(expires), body.decode("utf-8")
+        except ValueError:
+            return None
+
+    def set(self, key, body, ttl=None):
+        """
+        Store a body for `key`, for `ttl` seconds instead of the default if
+        given, and return True if it was stored.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        data = "{0!r}\n".format(time.time() + ttl) + body.encode("utf-8")
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=self.path, prefix=".")
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            # The directory is created on first use, so that it belongs to
+            # the (possibly unprivileged) process that writes to it
+            self.make_directory()
+            handle, temp_path = tempfile.mkstemp(dir=self.path, prefix=".")
+        try:
+            os.write(handle, data)
+        finally:
+            os.close(handle)
+        os.rename(temp_path, self.get_filename(key))
+
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % self.prune_interval == 0
+        if prune:
+            self.prune()
+        return True
+
+    def make_directory(self):
+        """
+        Create the cache directory unless another process already has.
+        """
+        try:
+            os.makedirs(self.path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def prune(self):
+        """
+        Remove the oldest entries if there are more than `max_entries`, along
+        with any temporary files that were left behind.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue  # removed by another process
+            if name.startswith(".") and mtime < time.time() - 60:
+                self.remove(path)
+            elif not name.startswith("."):
+                entries.append((mtime, path))
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            self.remove(path)
+
+    def remove(self, path):
+        """
+        Remove a file, ignoring files that have already been removed.
+        """
+        try:
+            os.unlink(path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+
+class MemcachedCache(CacheBackend):
+    """
+    Cache of serialized data API responses in one or more memcached servers,
+    so that it can be shared between hosts.
+
+    Keys are spread over the servers by hash. Bodies larger than
+    `compress_threshold` bytes are stored compressed with zlib, along with
+    their expiry time, and memcached is given the same TTL (plus `stale_ttl`)
+    so that it drops them by itself. The cache is an optimization only: if a
+    server can't be reached, reads are misses and writes are skipped.
+
+    Usage:
+        cache = MemcachedCache(["127.0.0.1:11211"], ttl=300)
+        api = StatAPI("my-script", cache=cache)
+    """
+    # Value of the memcached flags field for compressed entries
+    COMPRESSED = 1
+    key_prefix = "ripestat:"
+
+    def __init__(self, servers, ttl=300, timeout=0.5, compress_threshold=1024,
+                 max_idle=8, stale_ttl=0):
+        CacheBackend.__init__(self, ttl, stale_ttl)
+        self.timeout = timeout
+        self.compress_threshold = compress_threshold
+        self.servers = []
+        for server in servers:
+            host, _, port = server.rpartition(":")
+            self.servers.append(MemcachedServer(
+                host.strip("[]"), int(port), timeout, max_idle))
+
+    def get_server(self, key):
+        """
+        Return the server and the memcached key for a cache key.
+        """
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        digest = hashlib.sha1(key).hexdigest()
+        server = self.servers[int(digest[:8], 16) % len(self.servers)]
+        return server, self.key_prefix + digest
+
+    def read(self, key):
+        """
+        Return the (expiry time, body) of the entry for `key`, or None.
+        """
+        server, key = self.get_server(key)
+        if server.is_down():
+            return None
+        try:
+            value = server.get(key)
+        except (socket.error, MemcachedError) as exc:
+            LOG.warning("memcached get failed on %s: %s", server, exc)
+            return None
+        if value is None:
+            return None
+        flags, data = value
+        expires, _, body = data.partition("\n")
+        try:
+            if flags & self.COMPRESSED:
+                body = zlib.decompress(body)
+            return float(expires), body.decode("utf-8")
+        except (ValueError, zlib.error):
+            return None
+
+    def set(self, key, body, ttl=None):
+        """
+        Store a body for `key`, for `ttl` seconds instead of the default if
+        given, and return True if it was stored.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        body = body.encode("utf-8")
+        flags = 0
+        if len(body) > self.compress_threshold:
+            body = zlib.compress(body)
+            flags = self.COMPRESSED
+        data = "{0!r}\n".format(time.time() + ttl) + body
+        server, key = self.get_server(key)
+        if server.is_down():
+            return False
+        try:
+            # memcached TTLs are whole seconds
+            server.set(key, data, flags,
+                       max(1, int(ttl + self.stale_ttl + 0.5)))
+        except (socket.error, MemcachedError) as exc:
+            LOG.warning("memcached set failed on %s: %s", server, exc)
+            return False
+        return True
+
+
+class MemcachedError(Exception):
+    """
+    Raised when a memcached server sends an unexpected reply.
+    """
+
+
+class MemcachedServer(object):
+    """
+    A pool of connections to a single memcached server, speaking the text
+    protocol.
+
+    A server that can't be reached is marked as down for `retry_delay`
+    seconds, during which it isn't contacted at all, so that requests don't
+    each wait for the connection to time out.
+    """
+    retry_delay = 30
+
+    def __init__(self, host, port, timeout, max_idle):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        # Idle (socket, file) pairs
+        self.idle = Queue(max_idle)
+        # The time until which the server is considered down
+        self.down_until = 0
+
+    def is_down(self):
+        """
+        Return True if the server failed recently.
+        """
+        return time.time() < self.down_until
+
+    def __str__(self):
+        return "{0}:{1}".format(self.host, self.port)
+
+    def call(self, request, read_reply):
+        """
+        Send a request and return read_reply(file) using a pooled
+        connection. Connections that fail are discarded, and the server is
+        marked as down if it can't be reached.
+        """
+        try:
+            sock, handle = self.idle.get_nowait()
+        except Empty:
+            try:
+                sock = socket.create_connection((self.host, self.port),
+                                                self.timeout)
+            except socket.error:
+                self.down_until = time.time() + self.retry_delay
+                raise
+            handle = sock.makefile("rb")
+        try:
+            sock.sendall(request)
+            reply = read_reply(handle)
+        except Exception as exc:
+            handle.close()
+            sock.close()
+            if isinstance(exc, socket.error):
+                self.down_until = time.time() + self.retry_delay
+            raise
+        try:
+            self.idle.put_nowait((sock, handle))
+        except Full:
+            handle.close()
+            sock.close()
+        return reply
+
+    def get(self, key):
+        """
+        Return the (flags, data) stored for `key`, or None.
+        """
+        def read_reply(handle):
+            line = handle.readline()
+            if line == "END\r\n":
+                return None
+            parts = line.split()
+            if len(parts) != 4 or parts[0] != "VALUE":
+                raise MemcachedError(line.strip())
+            data = handle.read(int(parts[3]) + 2)[:-2]
+            if handle.readline() != "END\r\n":
+                raise MemcachedError("missing END")
+            return int(parts[2]), data
+        return self.call("get {0}\r\n".format(key), read_reply)
+
+    def set(self, key, data, flags, ttl):
+        """
+        Store data for `key` for `ttl` seconds.
+        """
+        def read_reply(handle):
+            line = handle.readline()
+            if line != "STORED\r\n":
+                raise MemcachedError(line.strip())
+        self.call("set {0} {1} {2} {3}\r\n{4}\r\n".format(
+            key, flags, ttl, len(data), data), read_reply)
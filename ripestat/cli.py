@@ -12,6 +12,8 @@ import sys
 from ripestat.api import StatAPI
 from ripestat.core import StatCore
 from ripestat.parser import BaseParser
+from ripestat.snapshot import Snapshot
+from ripestat.upstream import RetryPolicy
 
 
 class StatCLIParser(BaseParser):
@@ -32,7 +34,9 @@ class StatCLIParser(BaseParser):
     # Debug options
     extra_option_list = [
         make_option("--tracebacks", help="Show full error reports when "
-                    "widgets fail", action="store_true")
+                    "widgets fail", action="store_true"),
+        make_option("--snapshot", help="answer the data calls in this "
+                    "snapshot file locally (see ripestat-snapshot)"),
     ]
 
     def __init__(self, *args, **kwargs):
@@ -63,6 +67,13 @@ class StatCLI(object):
         """
         print(line.encode("utf-8"))
 
+    def output_raw(self, data):
+        """
+        Callback for outputting encoded records from the StatCore class.
+        """
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
     def main(self, params):
         """
         Process some command line parameters and pass them to StatCore.
@@ -78,8 +89,14 @@ class StatCLI(object):
         else:
             logger.setLevel(logging.CRITICAL)
 
-        api = StatAPI("cli", base_url=base_url, token=token)
-        stat = StatCore(self.output, parser=self.parser, api=api)
+        snapshot = None
+        if options.snapshot:
+            snapshot = Snapshot(options.snapshot)
+
+        api = StatAPI("cli", base_url=base_url, token=token,
+                      retry_policy=RetryPolicy(), snapshot=snapshot)
+        stat = StatCore(self.output, parser=self.parser, api=api,
+                        raw_callback=self.output_raw)
         if (options.login or options.password) and not options.username:
             options.username = self.get_input("username: ")
         if options.username:
@@ -8,8 +8,10 @@ import logging
 from ripestat import __version__
 from ripestat.whois import WhoisSerializer
 from ripestat.data import DataProcessor
+from ripestat.formats import get_encoder
 from ripestat.rendering import WidgetRenderer
 from ripestat.parser import BaseParser, UserError
+from ripestat.resources import InvalidResource, normalize_resource, query_key
 
 
 class StatCore(DataProcessor, WidgetRenderer):
@@ -19,15 +21,32 @@ class StatCore(DataProcessor, WidgetRenderer):
     Calling classes can specify their own parser with more options. These
     custom parsers must however subclass BaseParser.
     """
-    def __init__(self, callback, api, parser=None):
-        logging.basicConfig()
-        self.logger = logging.getLogger("ripestat")
+    # Function that encodes a record for the machine-readable output
+    # formats, or None for whois-style text
+    encoder = None
+    # Maximum number of resources in a single command line (None is
+    # unlimited), since each one multiplies the data calls
+    max_resources = None
+
+    logger = logging.getLogger("ripestat")
+
+    def __init__(self, callback, api, parser=None, raw_callback=None):
+        # Cores are created for every connection of the server, so logging is
+        # only configured if nothing else has configured it yet
+        if not logging.root.handlers:
+            logging.basicConfig()
 
         # This function is called whenever something needs to be output to the
         # user.
         self.output = callback
+        # This function is called with already encoded byte strings for the
+        # machine-readable output formats. Without it only line-based formats
+        # are available.
+        self.raw_output = raw_callback
 
         self.api = api
+        # The running mode is added to this for each command line
+        self.caller_id = api.caller_id
 
         if parser:
             assert isinstance(parser, BaseParser), \
@@ -38,14 +57,17 @@ class StatCore(DataProcessor, WidgetRenderer):
 
         self.serializer = WhoisSerializer()
 
-    def main(self, args):
+    def main(self, args, options=None):
         """
         Process the command line from the user and print a response to stdout.
 
+        If the command line has already been parsed, `options` are the parsed
+        options and `args` the remaining positional arguments.
+
         This method calls self._main() so that it can catch UserError.
         """
         try:
-            return self._main(args)
+            return self._main(args, options)
         except UserError as exc:
             if exc.message:
                 self.output(exc.message)
@@ -55,13 +77,14 @@ class StatCore(DataProcessor, WidgetRenderer):
                 self.output(self.parser.format_option_help())
             return 1
 
-    def _main(self, args):
+    def _main(self, args, options=None):
         """
         Internal method for responding to a command line.
 
         May raise UserError.
         """
-        options, args = self.parser.parse_args(args)
+        if options is None:
+            options, args = self.parser.parse_args(args)
 
         if options.verbose == 1:
             self.logger.setLevel(logging.INFO)
@@ -79,29 +102,48 @@ class StatCore(DataProcessor, WidgetRenderer):
         elif options.explain_data_call:
             return self.explain_data_call(options.explain_data_call)
 
+        try:
+            self.encoder = get_encoder(options.format)
+        except ValueError as exc:
+            raise UserError(exc.args[0])
+        if options.format == "msgpack" and not self.raw_output:
+            raise UserError("The msgpack format isn't available here.")
+
         query = StatQuery(*args)
+        if self.max_resources is not None and \
+                len(query.resources) > self.max_resources:
+            raise UserError("At most {0} resources can be queried at "
+                            "once.".format(self.max_resources))
 
         if options.data_call and options.widgets:
             raise UserError(
                 "--data-call and --widgets are conflicting options",
                 show_help=True)
+        elif options.template and self.encoder:
+            raise UserError(
+                "--template and --format are conflicting options",
+                show_help=True)
         elif options.data_call:
-            self.api.caller_id += "/data-call"
+            self.api.caller_id = self.caller_id + "/data-call"
             try:
-                return self.output_data(
-                    options.data_call, query,
-                    include_metadata=options.include_metadata,
-                    abbreviate=options.abbreviate_data, select=options.select,
-                    template=options.template)
+                for resource_query in query.split():
+                    self.output_data(
+                        options.data_call, resource_query,
+                        include_metadata=options.include_metadata,
+                        abbreviate=options.abbreviate_data,
+                        select=options.select, template=options.template)
             except self.api.ServerError as exc:
                 if exc.status_code == 400:
                     raise UserError(exc.args[0], show_help=False)
+            except self.api.BusyError as exc:
+                raise UserError(exc.args[0], show_help=False)
         else:
-            self.api.caller_id += "/widgets"
+            self.api.caller_id = self.caller_id + "/widgets"
             return self.output_widgets(
                 options.widgets, query,
                 include_metadata=options.include_metadata,
-                preserve_order=options.preserve_order)
+                preserve_order=options.preserve_order,
+                deadline=options.deadline)
 
     def show_version(self):
         """
@@ -116,43 +158,84 @@ class StatCore(DataProcessor, WidgetRenderer):
         output = self.serializer.dumps(lines, **kwargs)
         self.output(output)
 
+    def output_record(self, record):
+        """
+        Output a record in the chosen machine-readable format.
+        """
+        data = self.encoder(record)
+        if self.raw_output:
+            self.raw_output(data)
+        else:
+            self.output(data.rstrip("\n").decode("utf-8"))
+
 
 class StatQuery(dict):
     """
     A dictionary of parameters for passing to a widget or data call.
+
+    Several resources can be given; the 'resource' parameter is set to the
+    first one, and split() returns a query for each of them.
     """
-    __slots__ = "resource_type"
+    __slots__ = "resource_type", "resources"
 
     def __init__(self, *args):
         """
         Convert positional key=value arguments to a Python dict.
 
+        The resources are converted to their canonical form. UserError is
+        raised if any of them is not a valid resource.
+
         >>> query = StatQuery("year=2011", "limit=5", "as3333")
         >>> query == {
         ...    "year": "2011",
         ...    "limit": "5",
-        ...    "resource": "as3333"
+        ...    "resource": "AS3333"
         ... }
         True
         >>> query.resource_type
         'asn'
+        >>> [q["resource"] for q in StatQuery("as3333", "193/21").split()]
+        ['AS3333', '193.0.0.0/21']
         """
         dict.__init__(self)
+        resources = []
         for arg in args:
             parts = arg.split("=", 1)
             if len(parts) == 1:
-                self["resource"] = parts[0]
+                resources.append(parts[0])
+            elif parts[0] == "resource":
+                resources.append(parts[1])
             else:
                 self[parts[0]] = parts[1]
 
-        # Work out the resource type
-        resource = self.get("resource")
-        if resource:
-            if "." in resource or "/" in resource or ":" in resource:
-                self.resource_type = "ip"
-            elif resource.lower().replace("as", "").isdigit():
-                self.resource_type = "asn"
-            else:
-                self.resource_type = "unknown"
-        else:
-            self.resource_type = None
+        # Work out the canonical resources and their types
+        self.resources = []
+        self.resource_type = None
+        for resource in resources:
+            if not resource:
+                continue
+            try:
+                resource, resource_type = normalize_resource(resource)
+            except InvalidResource as exc:
+                raise UserError(exc.args[0])
+            if not self.resources:
+                self["resource"] = resource
+                self.resource_type = resource_type
+            self.resources.append(resource)
+
+    def split(self):
+        """
+        Return a list with a StatQuery for each resource, in order.
+        """
+        if len(self.resources) <= 1:
+            return [self]
+        params = ["{0}={1}".format(key, value) for key, value in self.items()
+                  if key != "resource"]
+        return [StatQuery(resource, *params) for resource in self.resources]
+
+    @property
+    def cache_key(self):
+        """
+        A hashable key for the query that doesn't depend on parameter order.
+        """
+        return query_key(self)
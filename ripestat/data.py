@@ -59,6 +59,30 @@ class DataProcessor(object):
             if not template and not abbreviate:
                 template = "{0}"
 
+        if self.encoder is not None:
+            # Records are output without any templating, and lists an element
+            # at a time so that consumers can process them as they arrive
+            if abbreviate:
+                data = self.abbreviate_lists(data, insert_ellipsis=False)
+            if isinstance(data, list):
+                for item in data:
+                    self.output_record(item)
+            else:
+                self.output_record(data)
+        else:
+            self.output_text(data, abbreviate, template)
+
+        if not include_metadata:
+            if response.meta.get("cached", False):
+                self.logger.log(logging.INFO, "This response was cached")
+            if response.meta.get("stale", False):
+                self.logger.log(logging.WARNING,
+                                "This response may be out of date")
+
+    def output_text(self, data, abbreviate=False, template=None):
+        """
+        Output data as indented JSON or using a template.
+        """
         if abbreviate:
             data = self.abbreviate_lists(data)
 
@@ -73,10 +97,6 @@ class DataProcessor(object):
 
         self.output(output)
 
-        if not include_metadata:
-            if response.meta.get("cached", False):
-                self.logger.log(logging.INFO, "This response was cached")
-
     ellipsis_marker = "...abbreviate_lists_ELLIPSIS..."
 
     def abbreviate_lists(self, data, insert_ellipsis=True, top_level=True):
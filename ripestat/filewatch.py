@@ -0,0 +1,135 @@
+"""
+Notification of changes to a file, using inotify where it is available.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# struct inotify_event without the name that follows it
+EVENT = struct.Struct("iIII")
+
+
+def load_inotify():
+    """
+    Return the C library if it provides inotify, otherwise None.
+    """
+    name = ctypes.util.find_library("c")
+    if not name:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FileWatcher(object):
+    """
+    Wait for a file to be modified.
+
+    The directory containing the file is watched rather than the file
+    itself, so that files replaced by renaming a new version over them (as
+    many editors and deploy tools do) are noticed too. Where inotify isn't
+    available the modification time is polled instead.
+
+    Usage:
+        watcher = FileWatcher("/etc/service.conf")
+        while True:
+            if watcher.wait(5):
+                reload()
+    """
+    # Time in seconds without further events before a change is reported,
+    # so that a file written in several steps causes a single reload
+    settle_time = 0.5
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.mtime = self.get_mtime()
+        self.fd = None
+        libc = load_inotify()
+        if libc is not None:
+            fd = libc.inotify_init()
+            if fd >= 0:
+                directory = os.path.dirname(self.path)
+                if libc.inotify_add_watch(fd, directory, WATCH_MASK) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+    def get_mtime(self):
+        """
+        Return the modification time of the file, or None if it is missing.
+        """
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds and return True if the file changed.
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            mtime = self.get_mtime()
+            changed = mtime != self.mtime
+            self.mtime = mtime
+            return changed
+
+        end_time = time.time() + timeout
+        while not self.read_events(end_time - time.time()):
+            if time.time() >= end_time:
+                return False
+        # Wait for the writes to finish
+        while self.read_events(self.settle_time):
+            pass
+        return True
+
+    def read_events(self, timeout):
+        """
+        Read the pending inotify events, waiting up to `timeout` seconds for
+        one, and return True if any of them were about the file.
+        """
+        try:
+            readable = select.select([self.fd], [], [], max(0, timeout))[0]
+        except select.error as exc:
+            if exc.args[0] == errno.EINTR:
+                return False
+            raise
+        if not readable:
+            return False
+        data = os.read(self.fd, 65536)
+        name = os.path.basename(self.path)
+        offset = 0
+        found = False
+        while offset < len(data):
+            _, _, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            event_name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if event_name == name:
+                found = True
+        return found
+
+    def close(self):
+        """
+        Stop watching the file.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
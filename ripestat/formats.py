@@ -0,0 +1,58 @@
+"""
+Machine-readable output formats for widget results and data call responses.
+
+Each record is encoded on its own, so that records can be written as soon as
+they are available:
+
+    ndjson      one compact JSON document per line
+    msgpack     a 4 byte big-endian length followed by a msgpack document
+                (requires the msgpack package)
+"""
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from ripestat.api import json
+
+
+FORMATS = ["text", "ndjson", "msgpack"]
+
+LENGTH = struct.Struct("!I")
+
+
+def encode_ndjson(record):
+    """
+    Encode a record as a line of JSON.
+    """
+    return json.dumps(record, separators=(",", ":"), default=unicode) + "\n"
+
+
+def encode_msgpack(record):
+    """
+    Encode a record as a length-prefixed msgpack document.
+    """
+    body = msgpack.packb(record, default=unicode, use_bin_type=False)
+    return LENGTH.pack(len(body)) + body
+
+
+ENCODERS = {
+    "ndjson": encode_ndjson,
+    "msgpack": encode_msgpack,
+}
+
+
+def get_encoder(output_format):
+    """
+    Return the function that encodes records in the given format, or None
+    for the whois-style text format.
+
+    Raises ValueError if the format can't be used.
+    """
+    if output_format in (None, "text"):
+        return None
+    if output_format == "msgpack" and msgpack is None:
+        raise ValueError("The msgpack format requires the msgpack package.")
+    return ENCODERS[output_format]
@@ -0,0 +1,138 @@
+"""
+Tools for bounding the amount of concurrent work done on behalf of clients.
+"""
+import threading
+import time
+
+
+class ConcurrencyLimit(object):
+    """
+    A counting semaphore that waits a bounded amount of time for a free slot.
+
+    Usage:
+        limit = ConcurrencyLimit(10, timeout=5)
+        if limit.acquire():
+            try:
+                ...
+            finally:
+                limit.release()
+    """
+    def __init__(self, limit, timeout=None):
+        self.limit = limit
+        # Default number of seconds to wait for a slot (None waits forever)
+        self.timeout = timeout
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Take a slot, returning False if none became free in time.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        with self.condition:
+            if not wait_for(self.condition, lambda: self.active < self.limit,
+                            timeout):
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        """
+        Give back a slot taken with acquire().
+        """
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+class ClientLimits(object):
+    """
+    Per-client bookkeeping of open connections and in-flight queries.
+
+    Clients are identified by any hashable key, usually the peer address.
+    A limit of None means that the corresponding resource is unlimited.
+
+    Nothing ever waits for a slot: a client that is over its limits is
+    refused straight away, so it can't tie up threads that other clients
+    need.
+    """
+    def __init__(self, max_connections=None, max_queries=None):
+        self.max_connections = max_connections
+        self.max_queries = max_queries
+        self.connections = {}
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def connection_opened(self, client):
+        """
+        Register a new connection, returning False if the client already has
+        too many.
+        """
+        with self.lock:
+            count = self.connections.get(client, 0)
+            if self.max_connections is not None and \
+                    count >= self.max_connections:
+                return False
+            self.connections[client] = count + 1
+            return True
+
+    def connection_closed(self, client):
+        """
+        Unregister a connection that was accepted by connection_opened().
+        """
+        with self.lock:
+            decrement(self.connections, client)
+
+    def acquire_query(self, client):
+        """
+        Take one of the client's query slots, returning False if the client
+        already has too many queries in flight.
+        """
+        if self.max_queries is None:
+            return True
+        with self.lock:
+            count = self.queries.get(client, 0)
+            if count >= self.max_queries:
+                return False
+            self.queries[client] = count + 1
+            return True
+
+    def release_query(self, client):
+        """
+        Give back a query slot taken with acquire_query().
+        """
+        if self.max_queries is None:
+            return
+        with self.lock:
+            decrement(self.queries, client)
+
+
+def wait_for(condition, predicate, timeout):
+    """
+    Wait on an acquired condition until predicate() is true or `timeout`
+    seconds have passed. Returns the final value of predicate().
+    """
+    if timeout is None:
+        while not predicate():
+            condition.wait()
+        return True
+    end_time = time.time() + timeout
+    while not predicate():
+        remaining = end_time - time.time()
+        if remaining <= 0:
+            return False
+        condition.wait(remaining)
+    return True
+
+
+def decrement(counts, key):
+    """
+    Decrement a counter in a dict, removing it when it drops to zero so that
+    the dict doesn't grow with every client ever seen.
+    """
+    count = counts.get(key, 0) - 1
+    if count > 0:
+        counts[key] = count
+    else:
+        counts.pop(key, None)
@@ -3,6 +3,8 @@ Tools for parsing user/client input.
 """
 from optparse import OptionParser, OptionGroup, make_option
 
+from ripestat.formats import FORMATS
+
 
 class BaseParser(OptionParser):
     """
@@ -21,6 +23,10 @@ class BaseParser(OptionParser):
                     help="show this help text"),
         make_option("-m", "--include-metadata", action="store_true",
                     help="include metadata in the responses"),
+        make_option("-f", "--format", choices=FORMATS, help="output "
+                    "format: text (default), ndjson (a JSON record per "
+                    "widget or data item) or msgpack (length-prefixed "
+                    "records)"),
     ]
 
     # Widget options
@@ -32,6 +38,9 @@ class BaseParser(OptionParser):
         make_option("-o", "--preserve-order", action="store_true",
                     help="force the widgets to be returned in the same "
                     "order even if some are faster than others"),
+        make_option("--deadline", type="float", help="seconds to wait for "
+                    "the widgets before showing partial results and marking "
+                    "the rest as timed out"),
     ]
 
     # Data options
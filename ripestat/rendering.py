@@ -2,12 +2,15 @@
 Contains the text widget rendering functionality.
 """
 from abc import ABCMeta
+from Queue import Queue
 import logging
 import threading
+import time
 
 from ripestat import widgets
-from ripestat.api import StatAPI
+from ripestat.api import CallRecorder, RequestMemo, StatAPI
 from ripestat.parser import UserError
+from ripestat.upstream import thread_cpu_time
 
 
 LOG = logging.getLogger(__name__)
@@ -22,6 +25,24 @@ class WidgetRenderer(object):
     order_timeout = 0.2
     # Width of the key fields on the left in unordered mode
     unordered_key_width = 20
+    # Time in seconds after which unfinished widgets are reported as timed
+    # out (None waits for ever)
+    default_deadline = None
+    # Optional warming.CacheWarmer that is told about every widget query
+    warmer = None
+    # Maximum number of widgets that are executed at the same time for a
+    # single request
+    max_widget_threads = 8
+    # Optional scheduling.WidgetScheduler that executes the widgets of all
+    # requests instead of a WidgetPool per request
+    widget_scheduler = None
+    # Optional cache.ResponseCache for the output lines of widgets, keyed on
+    # (widget name, query, include_metadata)
+    widget_cache = None
+    # Optional function that sends buffered output to the user right away,
+    # called after the output of each widget so that it isn't held back by
+    # slower ones
+    flush_callback = None
 
     def list_widgets(self):
         """
@@ -60,91 +81,218 @@ class WidgetRenderer(object):
         return final_list
 
     def output_widgets(self, widgets_spec, query, include_metadata=False,
-                       preserve_order=False):
+                       preserve_order=False, deadline=None):
         """
-        Carry out queries for the given resource and display results for the
+        Carry out queries for the given resources and display results for the
         specified widgets.
+
+        The widgets of all resources are executed by a shared pool of
+        threads, and each resource is output in turn in the order given.
+        Widgets that haven't finished `deadline` seconds after the start of
+        the request are reported as timed out.
         """
-        widget_names = self.get_widgets(widgets_spec, query.resource_type)
-        if not widget_names:
-            if "resource" in query:
-                raise UserError("No widgets match the given resource "
-                                "type.")
-            else:
-                raise UserError(show_help=True)
-
-        header = []
-        if "resource" in query:
-            header.append("Results for '%s'" % query["resource"])
-            header.append("You can see graphical visualizations at "
-                          "https://stat.ripe.net/" + query["resource"])
-            self.output_whois(header)
-
-        # Execute each widget in parallel
-        threads = []
-        for widget_name in widget_names:
-            result = []
-
-            def closure(widget_name=widget_name, result=result):
-                """
-                Execute a widget and put its result in a list of its own.
-                """
-                lines = self.exec_widget(widget_name, query, include_metadata)
-                result.extend(lines)
-            thread = threading.Thread(target=closure)
-            thread.daemon = True  # makes the thread die with the controller
-            threads.append((thread, result))
+        if deadline is None:
+            deadline = self.default_deadline
+        if deadline is None:
+            end_time = None
+        else:
+            end_time = time.time() + deadline
 
-        for thread, result in threads:
-            thread.start()
+        queries = query.split()
+        plans = []
+        for resource_query in queries:
+            widget_names = self.get_widgets(widgets_spec,
+                                            resource_query.resource_type)
+            if not widget_names:
+                if len(queries) > 1:
+                    plans.append((resource_query, None))
+                    continue
+                elif "resource" in resource_query:
+                    raise UserError("No widgets match the given resource "
+                                    "type.")
+                else:
+                    raise UserError(show_help=True)
+            if self.warmer:
+                self.warmer.record(resource_query, widget_names)
+            plans.append((resource_query, widget_names))
+
+        # Execute the widgets in parallel, sharing identical data calls
+        memo = RequestMemo(self.api)
+        pool = self.widget_scheduler
+        if pool is None:
+            pool = WidgetPool(self.max_widget_threads)
+        for index, (resource_query, widget_names) in enumerate(plans):
+            if widget_names is None:
+                continue
+            jobs = []
+            for widget_name in widget_names:
+                jobs.append(pool.submit(widget_name, end_time,
+                                        self.exec_widget, widget_name,
+                                        resource_query, include_metadata,
+                                        api=memo))
+            plans[index] = resource_query, jobs
+        if pool is not self.widget_scheduler:
+            pool.close()
 
         # Output the widgets
         try:
-            if preserve_order:
-                # Render each widget in order, using a dynamically calculated
-                # key width
-                results = []
-                for thread, result in threads:
-                    thread.join(None)
-                    results.append("")
-                    results.extend(result)
-                self.output_whois(results)
+            if self.encoder is not None:
+                self.output_widget_records(plans, end_time)
             else:
-                # Render the widgets as they become available (loosely in
-                # order) using a constant minimum key width
-                while threads:
-                    for thread_info in threads[:]:
-                        thread, result = thread_info
-                        thread.join(self.order_timeout)
-                        if not thread.isAlive():
-                            self.output("")
-                            self.output_whois(
-                                result, min_key_width=self.unordered_key_width)
-                            threads.remove(thread_info)
+                self.output_widget_text(plans, preserve_order, end_time)
         except KeyboardInterrupt:
             return
 
+        if memo.saved:
+            self.logger.info("%d duplicate data calls were saved", memo.saved)
         return 0
 
-    def exec_widget(self, widget_name, query, include_metadata):
+    def output_widget_text(self, plans, preserve_order, end_time):
+        """
+        Output the results of the widget jobs for each resource in the
+        whois-style format, under a header for the resource.
+        """
+        for resource_query, jobs in plans:
+            if "resource" in resource_query:
+                resource = resource_query["resource"]
+                self.output_whois([
+                    "Results for '%s'" % resource,
+                    "You can see graphical visualizations at "
+                    "https://stat.ripe.net/" + resource,
+                ])
+            if jobs is None:
+                self.output("")
+                self.output_whois(["No widgets match the given resource "
+                                   "type."])
+            elif preserve_order:
+                self.output_ordered(jobs, end_time)
+            else:
+                self.output_unordered(jobs, end_time)
+
+    def output_ordered(self, jobs, end_time):
+        """
+        Render the result of each widget job in order, using a dynamically
+        calculated key width.
+        """
+        results = []
+        for job in jobs:
+            job.done.wait(time_left(end_time))
+            results.append("")
+            if job.finished:
+                results.extend(job.result)
+            else:
+                results.append(self.timed_out_line(job.name))
+        self.output_whois(results)
+        self.flush_output()
+
+    def output_unordered(self, jobs, end_time):
+        """
+        Render the results of widget jobs as they become available (loosely
+        in order) using a constant minimum key width.
+        """
+        jobs = list(jobs)
+        while jobs:
+            for job in jobs[:]:
+                timeout = time_left(end_time)
+                if timeout is None or timeout > self.order_timeout:
+                    timeout = self.order_timeout
+                job.done.wait(timeout)
+                if job.finished:
+                    self.output("")
+                    self.output_whois(
+                        job.result, min_key_width=self.unordered_key_width)
+                    self.flush_output()
+                    jobs.remove(job)
+            if jobs and time_left(end_time) == 0:
+                for job in jobs:
+                    self.output("")
+                    self.output_whois([self.timed_out_line(job.name)])
+                break
+
+    def output_widget_records(self, plans, end_time):
+        """
+        Output a record for each widget job in order, as soon as it and the
+        jobs before it are done.
+
+        Whois-style lines are kept in order in the 'items' list, with key,
+        value pairs as two element lists. Widgets that failed or timed out
+        have an 'error' instead.
+        """
+        for resource_query, jobs in plans:
+            resource = resource_query.get("resource")
+            if jobs is None:
+                self.output_record({
+                    "resource": resource,
+                    "error": "No widgets match the given resource type.",
+                })
+                continue
+            for job in jobs:
+                job.done.wait(time_left(end_time))
+                record = {"resource": resource, "widget": job.name}
+                if not job.finished:
+                    record["error"] = "timed out"
+                elif isinstance(job.result, ErrorResult):
+                    record["error"] = job.result.message
+                else:
+                    record["items"] = job.result
+                self.output_record(record)
+                self.flush_output()
+
+    def flush_output(self):
+        """
+        Send the output so far to the user if it is buffered.
+        """
+        if self.flush_callback is not None:
+            self.flush_callback()
+
+    def timed_out_line(self, widget_name):
+        """
+        Return the line that replaces the output of an unfinished widget.
+        """
+        return u"%{0}: timed out".format(widget_name)
+
+    def stale_line(self, widget_name):
+        """
+        Return the line that marks the output of a widget that was made from
+        stale cached data.
+        """
+        return u"%{0}: this data may be out of date".format(widget_name)
+
+    def exec_widget(self, widget_name, query, include_metadata, api=None):
         """
         Execute a widget and return a list of output lines.
+
+        The widget uses `api` if given, otherwise self.api.
+
+        If there is a widget cache, the output is cached for as long as all
+        of the data call responses that it was made from stay cached.
         """
+        cache_key = None
+        if self.widget_cache is not None:
+            cache_key = (widget_name, query.cache_key, bool(include_metadata))
+            lines = self.widget_cache.get(cache_key)
+            if lines is not None:
+                return list(lines)
+
         widget = widgets.get_widget(widget_name)
+        costs = None
+        if self.widget_scheduler is not None:
+            costs = self.widget_scheduler.call_costs
+        recorder = CallRecorder(api or self.api, costs)
+        start = time.time()
+        start_cpu = thread_cpu_time()
         try:
-            result = widget(self.api, query)
-        except StatAPI.Error as exc:
-            result = exc
+            result = widget(recorder, query)
         except Exception as exc:
-            if isinstance(exc, StatAPI.Error):
+            if isinstance(exc, (StatAPI.Error, UserError)):
                 message = unicode(exc)
             else:
                 message = "There was an error rendering this widget."
                 logging.exception(exc)
 
-            result = [
+            result = ErrorResult(message, [
                 u"%{0}: {1}".format(widget_name, message)
-            ]
+            ])
         else:
             response, result = result
             time_str = ""
@@ -167,4 +315,141 @@ class WidgetRenderer(object):
             if include_metadata:
                 for key in response.meta:
                     result.append(("meta-" + key, response.meta[key]))
+            if recorder.stale:
+                result.append(self.stale_line(widget_name))
+            if cache_key is not None:
+                self.cache_widget_output(cache_key, recorder, result)
+        if self.widget_scheduler is not None:
+            # Cached output is left out so that it doesn't make the widget
+            # look cheaper than it is
+            self.widget_scheduler.widget_costs.record(
+                widget_name, time.time() - start,
+                thread_cpu_time() - start_cpu)
         return result
+
+    def cache_widget_output(self, cache_key, recorder, lines):
+        """
+        Cache the output lines of a widget until the first of its data call
+        responses expires.
+        """
+        if not recorder.expiries or None in recorder.expiries:
+            return  # the output can't be kept fresh
+        ttl = min(recorder.expiries) - time.time()
+        if ttl > 0:
+            self.widget_cache.set(cache_key, list(lines), ttl=ttl)
+
+
+class ErrorResult(list):
+    """
+    List subclass that holds the output lines of a widget that failed, so
+    that the error message can be reported separately.
+    """
+    def __init__(self, message, lines):
+        list.__init__(self, lines)
+        self.message = message
+
+
+class WidgetPool(object):
+    """
+    A bounded number of daemon threads that execute jobs in the order in
+    which they were submitted. Jobs that are still queued at their end time
+    are skipped.
+
+    Usage:
+        pool = WidgetPool(4)
+        job = pool.submit("name", time.time() + 10, func, arg)
+        pool.close()
+        job.done.wait()
+        print(job.result)
+    """
+    def __init__(self, size):
+        self.size = size
+        self.threads = []
+        self.queue = Queue()
+
+    def submit(self, name, end_time, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) to run before `end_time` (None runs it
+        whenever a thread is free) and return a WidgetJob for it.
+        """
+        job = WidgetJob(name, end_time, func, args, kwargs)
+        self.queue.put(job)
+        if len(self.threads) < self.size:
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True  # makes the thread die with the controller
+            thread.start()
+            self.threads.append(thread)
+        return job
+
+    def close(self):
+        """
+        Let the threads finish once all of the submitted jobs are done.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+
+    def work(self):
+        """
+        Execute jobs until close() is called.
+        """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if job.expired():
+                job.time_out()
+                continue
+            try:
+                job.result = job.func(*job.args, **job.kwargs)
+            finally:
+                job.done.set()
+
+
+class WidgetJob(object):
+    """
+    A function call executed by a WidgetPool. `done` is set once `result`
+    is available, or once the job was given up on (see `timed_out`).
+    """
+    __slots__ = ("name", "end_time", "func", "args", "kwargs", "result",
+                 "done", "timed_out", "submitted")
+
+    def __init__(self, name, end_time, func, args, kwargs):
+        self.name = name
+        self.end_time = end_time
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = []
+        self.done = threading.Event()
+        self.timed_out = False
+        self.submitted = time.time()
+
+    @property
+    def finished(self):
+        """
+        True if the job has run and its result is available.
+        """
+        return self.done.is_set() and not self.timed_out
+
+    def expired(self):
+        """
+        Return True if the end time of the job has passed.
+        """
+        return self.end_time is not None and time.time() >= self.end_time
+
+    def time_out(self):
+        """
+        Give up on the job without running it.
+        """
+        self.timed_out = True
+        self.done.set()
+
+
+def time_left(end_time):
+    """
+    Return the number of seconds until `end_time`, or None if there is no end
+    time.
+    """
+    if end_time is None:
+        return None
+    return max(0, end_time - time.time())
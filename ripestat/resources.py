@@ -0,0 +1,155 @@
+"""
+Parsing and canonicalization of the resources that users query for.
+
+Canonical forms are used so that equivalent queries (e.g. 'as3333', 'AS3333'
+and '3333') share cache entries.
+"""
+import re
+import socket
+import struct
+
+
+ASN_RE = re.compile(r"^(?:as)?(\d+)(?:\.(\d+))?$", re.IGNORECASE)
+HOSTNAME_RE = re.compile(r"^(?=.*[a-z])[a-z0-9-]+(\.[a-z0-9-]+)+\.?$",
+                         re.IGNORECASE)
+RANGE_RE = re.compile(r"^([\d.]+)-([\d.]+)$")
+# Anything made only of digits and dots is expected to be an IPv4 address
+NUMERIC_RE = re.compile(r"^[\d.]+$")
+# Hex digits, colons and dots with an optional prefix length are expected to
+# be an IP address or prefix if there is a colon or slash, unlike RPSL names
+# such as 'AS3333:AS-FOO'
+ADDRESS_RE = re.compile(r"^[\da-f:.]+(?:/.*)?$", re.IGNORECASE)
+
+MAX_ASN = 2 ** 32 - 1
+
+
+class InvalidResource(ValueError):
+    """
+    Raised when a resource looks like an ASN or IP address but isn't one.
+    """
+
+
+def normalize_resource(resource):
+    """
+    Return a (canonical resource, resource type) tuple for a user supplied
+    resource.
+
+    The resource type is one of 'asn', 'ip' or 'unknown'.
+
+    >>> normalize_resource("as3333")
+    ('AS3333', 'asn')
+    >>> normalize_resource("193.0.6.139/24")
+    ('193.0.6.0/24', 'ip')
+    >>> normalize_resource("193/21")
+    ('193.0.0.0/21', 'ip')
+    >>> normalize_resource("2001:67C:2e8::/48")
+    ('2001:67c:2e8::/48', 'ip')
+    >>> normalize_resource("AS-RIPENCC")
+    ('AS-RIPENCC', 'unknown')
+    >>> normalize_resource("AS3333:AS-FOO")
+    ('AS3333:AS-FOO', 'unknown')
+    """
+    resource = resource.strip()
+    match = ASN_RE.match(resource)
+    if match and (match.group(2) is None or resource[:2].lower() == "as"):
+        return normalize_asn(*match.groups()), "asn"
+    match = RANGE_RE.match(resource)
+    if match:
+        return "{0}-{1}".format(normalize_address(match.group(1)),
+                                normalize_address(match.group(2))), "ip"
+    if NUMERIC_RE.match(resource) or ADDRESS_RE.match(resource) and (
+            "/" in resource or ":" in resource):
+        return normalize_prefix(resource), "ip"
+    if HOSTNAME_RE.match(resource):
+        # The data API resolves hostnames to addresses
+        return resource.lower().rstrip("."), "ip"
+    return resource, "unknown"
+
+
+def normalize_asn(high, low=None):
+    """
+    Return the canonical form of an ASN given in asplain or (if `low` is
+    given) asdot notation.
+    """
+    asn = int(high)
+    if low is not None:
+        if asn > 0xffff or int(low) > 0xffff:
+            raise InvalidResource("invalid ASN: {0}.{1}".format(high, low))
+        asn = (asn << 16) + int(low)
+    if asn > MAX_ASN:
+        raise InvalidResource("invalid ASN: {0}".format(asn))
+    return "AS{0}".format(asn)
+
+
+def normalize_address(address):
+    """
+    Return the canonical form of an IPv4 or IPv6 address.
+    """
+    family, packed = parse_address(address)
+    return socket.inet_ntop(family, packed)
+
+
+def normalize_prefix(prefix):
+    """
+    Return the canonical form of an address or prefix, with any host bits of
+    a prefix set to zero. Abbreviated IPv4 prefixes such as '193/8' are
+    expanded.
+    """
+    if "/" not in prefix:
+        return normalize_address(prefix)
+    address, length = prefix.split("/", 1)
+    if ":" not in address:
+        # Pad abbreviated IPv4 prefixes like 193/8 and 193.0/16
+        octets = address.split(".")
+        if 0 < len(octets) < 4:
+            address = ".".join(octets + ["0"] * (4 - len(octets)))
+    family, packed = parse_address(address)
+    bits = len(packed) * 8
+    if not length.isdigit() or int(length) > bits:
+        raise InvalidResource("invalid prefix length: {0}".format(prefix))
+    length = int(length)
+    packed = mask_address(packed, length)
+    return "{0}/{1}".format(socket.inet_ntop(family, packed), length)
+
+
+def parse_address(address):
+    """
+    Return a (socket family, packed address) tuple for an IPv4 or IPv6
+    address.
+    """
+    if ":" in address:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+        # inet_pton is lax about some IPv4 forms on some platforms
+        octets = address.split(".")
+        if len(octets) != 4 or not all(o.isdigit() and int(o) < 256 for o in
+                                       octets):
+            raise InvalidResource("invalid IP address: {0}".format(address))
+    try:
+        return family, socket.inet_pton(family, address)
+    except (socket.error, ValueError):
+        raise InvalidResource("invalid IP address: {0}".format(address))
+
+
+def mask_address(packed, length):
+    """
+    Zero all but the first `length` bits of a packed address.
+    """
+    value = 0
+    for byte in struct.unpack("!%dB" % len(packed), packed):
+        value = (value << 8) | byte
+    bits = len(packed) * 8
+    value &= ((1 << bits) - 1) ^ ((1 << (bits - length)) - 1)
+    return struct.pack("!%dB" % len(packed), *[
+        (value >> shift) & 0xff for shift in range(bits - 8, -8, -8)])
+
+
+def query_key(query):
+    """
+    Return a hashable key for a dict of query parameters that doesn't depend
+    on their order.
+    """
+    if not query:
+        return ()
+    return tuple(sorted(query.items()))
@@ -0,0 +1,203 @@
+"""
+Scheduling of widget work across requests according to its learned cost.
+"""
+from collections import deque
+import logging
+import threading
+import time
+
+from ripestat.rendering import WidgetJob
+
+
+LOG = logging.getLogger(__name__)
+
+
+class CostTracker(object):
+    """
+    Keep moving averages of the latency and CPU time per key (a widget or
+    data call name).
+    """
+    # Weight of each new sample in the averages
+    alpha = 0.2
+
+    def __init__(self):
+        # key => (average latency, average CPU time)
+        self.costs = {}
+        self.lock = threading.Lock()
+
+    def record(self, key, latency, cpu=0.0):
+        """
+        Add the latency and CPU time (in seconds) of a run.
+        """
+        with self.lock:
+            old = self.costs.get(key)
+            if old is None:
+                self.costs[key] = latency, cpu
+            else:
+                alpha = self.alpha
+                self.costs[key] = (old[0] + alpha * (latency - old[0]),
+                                   old[1] + alpha * (cpu - old[1]))
+
+    def estimate(self, key):
+        """
+        Return the expected cost in seconds of a run, or None if there
+        haven't been any.
+
+        CPU time is counted on top of the latency because it also holds the
+        interpreter lock, slowing down the other threads.
+        """
+        with self.lock:
+            cost = self.costs.get(key)
+        if cost is None:
+            return None
+        return cost[0] + cost[1]
+
+    def most_expensive(self, count):
+        """
+        Return the (key, latency, CPU time) of the `count` most expensive
+        keys.
+        """
+        with self.lock:
+            costs = sorted(self.costs.items(), key=lambda item: sum(item[1]),
+                           reverse=True)[:count]
+        return [(key, latency, cpu) for key, (latency, cpu) in costs]
+
+
+class WidgetScheduler(object):
+    """
+    A pool of threads, shared by all requests, that runs cheap widgets
+    before expensive ones.
+
+    The cost of each widget is learned from its previous runs that weren't
+    answered from the widget cache (see WidgetRenderer.exec_widget); widgets
+    that are expected to take longer than `cheap_threshold` seconds are
+    expensive, and widgets that haven't run yet are assumed to be cheap.
+    `reserved` of the `size` threads only run cheap widgets, so that a few
+    requests for expensive widgets can't hold up quick lookups, and an
+    expensive widget that has been queued for `max_wait` seconds is taken
+    ahead of the cheap ones, so that it isn't starved by them. The cost of
+    data calls is tracked too (see CallRecorder) and reported by stats().
+
+    It can be used in place of a WidgetPool, except that it is never
+    closed. Like there, jobs that are still queued at their end time are
+    skipped, and jobs that don't fit in their queue (see `max_queued`) are
+    timed out right away.
+
+    Usage:
+        scheduler = WidgetScheduler(size=32, reserved=8)
+        job = scheduler.submit("routing-history", None, func, arg)
+        job.done.wait()
+        print(job.result)
+    """
+    # Number of widgets and data calls whose costs are reported by stats()
+    report_count = 3
+    # Seconds after which a queued expensive job is taken ahead of cheap ones
+    max_wait = 5
+    # Maximum number of jobs waiting in each of the queues
+    max_queued = 1000
+
+    def __init__(self, size=32, reserved=8, cheap_threshold=0.5):
+        self.size = size
+        # At least one thread must be left for expensive widgets
+        self.reserved = max(0, min(reserved, size - 1))
+        self.cheap_threshold = cheap_threshold
+        self.widget_costs = CostTracker()
+        self.call_costs = CostTracker()
+        self.cheap = deque()
+        self.expensive = deque()
+        self.condition = threading.Condition()
+        self.threads = []
+        # The number of jobs that were timed out because their queue was full
+        self.rejected = 0
+
+    def submit(self, name, end_time, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) as a run of the widget `name` before
+        `end_time` (None runs it whenever a thread is free) and return a
+        WidgetJob for it.
+        """
+        job = WidgetJob(name, end_time, func, args, kwargs)
+        cost = self.widget_costs.estimate(name)
+        expensive = cost is not None and cost > self.cheap_threshold
+        queue = self.expensive if expensive else self.cheap
+        with self.condition:
+            if not self.threads:
+                self.start()
+            if len(queue) >= self.max_queued:
+                self.rejected += 1
+                job.time_out()
+            elif expensive:
+                queue.append(job)
+                # Only some of the threads may take it
+                self.condition.notify_all()
+            else:
+                queue.append(job)
+                self.condition.notify()
+        return job
+
+    def start(self):
+        """
+        Start the threads. The lock must be held.
+        """
+        for index in range(self.size):
+            thread = threading.Thread(target=self.work,
+                                      args=(index < self.reserved,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self, reserved):
+        """
+        Execute jobs for ever, only taking cheap ones if `reserved`.
+        """
+        while True:
+            with self.condition:
+                while not (self.cheap or self.expensive and not reserved):
+                    self.condition.wait()
+                job = self.next_job(reserved)
+            if job.expired():
+                job.time_out()
+            else:
+                self.run(job)
+
+    def next_job(self, reserved):
+        """
+        Remove the job that a thread should run next from its queue and
+        return it. The lock must be held and a job must be available.
+        """
+        if reserved or not self.expensive:
+            return self.cheap.popleft()
+        if not self.cheap or \
+                self.expensive[0].submitted + self.max_wait <= time.time():
+            return self.expensive.popleft()
+        return self.cheap.popleft()
+
+    def run(self, job):
+        """
+        Execute a job.
+        """
+        try:
+            job.result = job.func(*job.args, **job.kwargs)
+        except Exception:
+            LOG.exception("Widget %s failed", job.name)
+        finally:
+            job.done.set()
+
+    def stats(self):
+        """
+        Return the queue lengths, the number of rejected jobs and the costs
+        of the most expensive widgets and data calls, as "latency/CPU time"
+        in milliseconds.
+        """
+        with self.condition:
+            stats = {
+                "queued-cheap": len(self.cheap),
+                "queued-expensive": len(self.expensive),
+                "rejected": self.rejected,
+            }
+        for prefix, costs in (("widget-", self.widget_costs),
+                              ("call-", self.call_costs)):
+            for key, latency, cpu in costs.most_expensive(self.report_count):
+                stats[prefix + key] = "{0:.0f}/{1:.0f}".format(
+                    latency * 1000, cpu * 1000)
+        return stats
@@ -5,15 +5,34 @@ The executable script for the whois service lives at scripts/ripestat-whois.
 """
 from optparse import make_option
 from Queue import Queue
+import os
+import threading
+import time
 
-from twisted.internet import reactor
+from twisted.application import service
+from twisted.internet import reactor, threads
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
 from twisted.protocols.basic import LineOnlyReceiver
 from twisted.python import log
+from zope.interface import implementer
 
+from ripestat.accesslog import AccessLog
 from ripestat.api import StatAPI
+from ripestat.cache import (
+    CompressedResponseCache, MemcachedCache, ResponseCache,
+    SharedResponseCache)
 from ripestat.core import StatCore
+from ripestat.limits import ClientLimits, ConcurrencyLimit
 from ripestat.parser import BaseParser
+from ripestat.scheduling import WidgetScheduler
+from ripestat.upstream import CircuitBreaker, RetryBudget, RetryPolicy
+from ripestat.warming import CacheWarmer
+
+
+BUSY_MESSAGE = "%ERROR: server busy, please try again later"
 
 
 class StatTextProtocol(LineOnlyReceiver):
@@ -26,20 +45,49 @@ class StatTextProtocol(LineOnlyReceiver):
         """
         Initialize state when the client connects.
         """
-        # Get the reader instance for this protocol
-        readers = reactor.getReaders()
-        for reader in readers:
-            if getattr(reader, "protocol", None) == self:
-                self.reader = reader
-                break
+        client = self.transport.getPeer()
+        self.client_host = client.host
+        self.admitted = self.factory.client_limits.connection_opened(
+            client.host)
+        if not self.admitted:
+            self.factory.access_log.log(
+                {"client": client.host, "event": "refused"})
+            self.sendLine(BUSY_MESSAGE)
+            self.transport.loseConnection()
+            return
+
+        self.factory.connections.add(self)
+        self.busy = False
+        # The number of requests that have been answered
+        self.completed = 0
+
         self.keep_alive = False
         self.input_lines = Queue()
-        client = self.transport.getPeer()
-        if client.host not in self.factory.dont_log:
-            log.msg("Connection from {0}".format(client))
+        self.output = OutputBuffer(self.transport,
+                                   write_timeout=self.factory.write_timeout)
+        self.transport.registerProducer(self.output, True)
+        self.factory.access_log.log(
+            {"client": client.host, "event": "connect"})
 
         self.api = StatAPI("whois", self.factory.base_url,
-                           headers=[("X-Forwarded-For", client.host)])
+                           headers=[("X-Forwarded-For", client.host)],
+                           **self.factory.api_options)
+        self.core = StatCore(self.queueLine, api=self.api,
+                             parser=self.factory.parser,
+                             raw_callback=self.queueBytes)
+        self.core.warmer = self.factory.warmer
+        self.core.widget_cache = self.factory.widget_cache
+        self.core.widget_scheduler = self.factory.widget_scheduler
+        self.core.max_resources = self.factory.max_resources
+        self.core.flush_callback = self.output.flush
+
+    def connectionLost(self, reason):
+        """
+        Release the client's connection slot.
+        """
+        if self.admitted:
+            self.factory.client_limits.connection_closed(self.client_host)
+            self.factory.connections.discard(self)
 
     def dataReceived(self, data):
         """
@@ -47,7 +95,10 @@ class StatTextProtocol(LineOnlyReceiver):
 
         This stops netcat from quitting before it gets the output!
         """
-        reactor.removeReader(self.reader)
+        if not self.admitted:
+            return
+        self.transport.pauseProducing()
+        self.busy = True
         retval = LineOnlyReceiver.dataReceived(self, data)
         reactor.getThreadPool().callInThreadWithCallback(
             self.processLinesDone, self.processLines)
@@ -55,11 +106,8 @@ class StatTextProtocol(LineOnlyReceiver):
 
     def lineReceived(self, line):
         """
-        Parse a line of user input and render the widgets.
+        Queue a line of user input for rendering.
         """
-        client = self.transport.getPeer()
-        if client.host not in self.factory.dont_log:
-            log.msg("Query: {1!r}".format(client.host, line))
         self.input_lines.put(line)
 
     def processLines(self):
@@ -77,26 +125,68 @@ class StatTextProtocol(LineOnlyReceiver):
                            "Bugs can be reported to stat@ripe.net.")
             reactor.callFromThread(log.err, result)
 
-        # Maintain or end the connection depending on the mode
-        if self.keep_alive:
-            reactor.callFromThread(reactor.addReader, self.reader)
+        self.output.flush()
+        reactor.callFromThread(self.requestDone)
+
+    def requestDone(self):
+        """
+        Maintain or end the connection depending on the mode, once the
+        output of a request has been queued.
+        """
+        self.busy = False
+        self.completed += 1
+        if self.keep_alive and not self.factory.draining:
+            self.transport.resumeProducing()
         else:
-            reactor.callFromThread(self.transport.loseConnection)
+            self.transport.unregisterProducer()
+            self.transport.loseConnection()
 
     def renderWidgets(self, line):
         """
         Execute the appropriate widgets and queue the output for sending from
         the main thread.
         """
+        start = time.time()
+        written = self.output.written
+        cache_hits = self.api.cache_hits
+        stale_hits = self.api.stale_hits
+        upstream_requests = self.api.upstream_requests
         params = line.strip().split()  # We need to accept trailing \r
 
-        parser = StatTextLineParser(self)
-        options, args = parser.parse_args(params)
+        options, args = self.factory.parser.parse_line(params, self.queueLine)
+        max_deadline = self.factory.max_deadline
+        if max_deadline is not None and (options.deadline is None or
+                                         options.deadline > max_deadline):
+            options.deadline = max_deadline
 
         # Render the widgets if the input wasn't a single keep_alive flag
         if not (options.keep_alive and not args):
-            core = StatCore(self.queueLine, api=self.api, parser=parser)
-            core.main(params)
+            record = {
+                "client": self.client_host,
+                "query": line.strip(),
+                "widgets": options.widgets,
+                "data-call": options.data_call,
+            }
+            limits = self.factory.client_limits
+            try:
+                if limits.acquire_query(self.client_host):
+                    try:
+                        self.core.main(args, options)
+                    finally:
+                        limits.release_query(self.client_host)
+                else:
+                    record["busy"] = True
+                    self.queueLine(BUSY_MESSAGE)
+            finally:
+                hits = self.api.cache_hits - cache_hits
+                upstream = self.api.upstream_requests - upstream_requests
+                record["latency"] = round(time.time() - start, 4)
+                record["bytes"] = self.output.written - written
+                record["upstream"] = upstream
+                record["cache"] = cache_status(hits, upstream)
+                if self.api.stale_hits > stale_hits:
+                    record["stale"] = self.api.stale_hits - stale_hits
+                self.factory.access_log.log(record)
 
         if options.keep_alive:
             self.keep_alive = not self.keep_alive
@@ -105,9 +195,116 @@ class StatTextProtocol(LineOnlyReceiver):
         """
         Callback method to allow StatCore to send output over the network.
 
-        Each line is queued in the main thread for sending.
+        Lines are buffered and handed to the main thread in batches.
+        """
+        self.output.write(line.encode("utf-8") + self.delimiter)
+
+    def queueBytes(self, data):
+        """
+        Callback method to allow StatCore to send encoded records over the
+        network, without adding delimiters.
+        """
+        self.output.write(data)
+
+
+@implementer(IPushProducer)
+class OutputBuffer(object):
+    """
+    Buffer for the output that a worker thread produces for a connection.
+
+    Output is handed to the reactor with a single writeSequence call once
+    `flush_size` bytes are buffered, `flush_interval` seconds have passed
+    since the last batch, or flush() is called, instead of waking up the
+    reactor for every line.
+
+    The buffer is registered with the transport as a producer. While the
+    transport is paused because the client doesn't read fast enough, the
+    worker thread waits in flush(), so a slow client can't make the server
+    buffer unbounded amounts of output. If the client doesn't read for
+    `write_timeout` seconds the connection is closed and the rest of the
+    output is discarded.
+    """
+    def __init__(self, transport, flush_size=65536, flush_interval=0.05,
+                 write_timeout=60):
+        self.transport = transport
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.write_timeout = write_timeout
+        self.chunks = []
+        self.size = 0
+        # The number of bytes written since the connection was made
+        self.written = 0
+        self.last_flush = time.time()
+        # Cleared while the transport is paused
+        self.writable = threading.Event()
+        self.writable.set()
+        self.closed = False
+
+    def write(self, data):
+        """
+        Add data to the buffer. Must only be called from one thread at a
+        time.
+        """
+        if self.closed:
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        self.written += len(data)
+        if self.size >= self.flush_size or \
+                time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the buffered data to the reactor, waiting while the transport
+        is paused.
+        """
+        if not self.chunks or self.closed:
+            return
+        if not self.writable.wait(self.write_timeout):
+            log.msg("Closing a connection that stopped reading")
+            self.stopProducing()
+            reactor.callFromThread(self.transport.abortConnection)
+            return
+        chunks = self.chunks
+        self.chunks = []
+        self.size = 0
+        self.last_flush = time.time()
+        reactor.callFromThread(self.transport.writeSequence, chunks)
+
+    def pauseProducing(self):
+        """
+        Called by the transport when its write buffer is full.
+        """
+        self.writable.clear()
+
+    def resumeProducing(self):
+        """
+        Called by the transport when its write buffer has been drained.
+        """
+        self.writable.set()
+
+    def stopProducing(self):
+        """
+        Called by the transport when the connection is lost.
         """
-        reactor.callFromThread(self.sendLine, line.encode("utf-8"))
+        self.closed = True
+        self.chunks = []
+        self.writable.set()
+
+
+def cache_status(hits, upstream):
+    """
+    Summarize how the data calls of a request were answered for the access
+    log.
+    """
+    if hits and upstream:
+        return "partial"
+    elif hits:
+        return "hit"
+    elif upstream:
+        return "miss"
+    return None
 
 
 class StatTextFactory(Factory):
@@ -115,33 +312,287 @@ class StatTextFactory(Factory):
     Twisted factory that uses the StatTextProtocol.
     """
     protocol = StatTextProtocol
+    # Time in seconds between logging the upstream request counters
+    stats_interval = 300
+    # Maximum number of cached client errors, which are kept apart from the
+    # cached responses
+    error_cache_size = 1000
 
-    def __init__(self, base_url, dont_log=None):
+    def __init__(self, base_url, dont_log=None, max_client_connections=None,
+                 max_client_queries=None, max_upstream_requests=None,
+                 queue_timeout=None, deadline=None, data_call_timeout=None,
+                 retries=0, hedge_percentile=None, retry_budget=0.1,
+                 breaker_failures=None, breaker_reset=30,
+                 breaker_slow_threshold=None, cache_ttl=None, cache_size=10000,
+                 cache_dir=None, warm_top=0, warm_interval=60,
+                 warm_budget=100, write_timeout=60, access_log=None,
+                 access_log_sample=1.0, widget_cache_size=0,
+                 cache_servers=None, cache_stale_ttl=0, error_cache_ttl=0,
+                 cache_memory=None, widget_threads=0,
+                 reserved_widget_threads=8, cheap_widget_time=0.5,
+                 request_threads=None, max_deadline=None,
+                 max_resources=None):
         self.base_url = base_url
-        if dont_log:
-            self.dont_log = dont_log
+        # Seconds to wait for a client that doesn't read its output
+        self.write_timeout = write_timeout
+        # Prebuilt parser for the input lines of all of the connections
+        self.parser = StatTextLineParser()
+        # Default for the --deadline option of each query
+        self.parser.set_defaults(deadline=deadline)
+        # Longest --deadline that clients may ask for
+        self.max_deadline = max_deadline
+        # Maximum number of resources in a single query line
+        self.max_resources = max_resources
+        # Access log records are written in the background, either to a file
+        # or in batches to the Twisted log. The file is only opened by
+        # startFactory(), so that supervising processes that load the same
+        # configuration don't hold it open.
+        self.access_log_path = access_log
+        self.access_log_file = None
+        if access_log:
+            def write(lines):
+                self.access_log_file.writelines(lines)
+                self.access_log_file.flush()
         else:
-            self.dont_log = []
+            def write(lines):
+                reactor.callFromThread(log.msg, "".join(lines).rstrip("\n"))
+        self.access_log = AccessLog(write, sample_rate=access_log_sample,
+                                    exclude=dont_log or ())
+
+        # Admission control is shared between all of the connections
+        self.client_limits = ClientLimits(
+            max_connections=max_client_connections,
+            max_queries=max_client_queries)
+        # Size of the reactor thread pool, which runs one request per thread
+        self.request_threads = request_threads
+
+        # Keyword arguments for the StatAPI instance of each connection
+        self.api_options = {}
+        if max_upstream_requests:
+            self.api_options["upstream_limit"] = ConcurrencyLimit(
+                max_upstream_requests, timeout=queue_timeout)
+        if data_call_timeout:
+            self.api_options["timeout"] = data_call_timeout
+        if retries or hedge_percentile:
+            self.api_options["retry_policy"] = RetryPolicy(
+                max_retries=retries, hedge_percentile=hedge_percentile,
+                budget=RetryBudget(ratio=retry_budget))
+        if breaker_failures:
+            self.api_options["circuit_breaker"] = CircuitBreaker(
+                max_failures=breaker_failures, reset_timeout=breaker_reset,
+                slow_threshold=breaker_slow_threshold)
+        if cache_ttl and cache_servers:
+            # Shared with the other servers behind the load balancer
+            self.api_options["cache"] = MemcachedCache(
+                cache_servers, ttl=cache_ttl, stale_ttl=cache_stale_ttl)
+        elif cache_ttl and cache_dir:
+            # Shared with the other worker processes on this host
+            self.api_options["cache"] = SharedResponseCache(
+                cache_dir, ttl=cache_ttl, max_entries=cache_size,
+                stale_ttl=cache_stale_ttl)
+        elif cache_ttl and cache_memory:
+            self.api_options["cache"] = CompressedResponseCache(
+                ttl=cache_ttl, max_bytes=cache_memory,
+                stale_ttl=cache_stale_ttl)
+        elif cache_ttl:
+            self.api_options["cache"] = ResponseCache(
+                ttl=cache_ttl, max_entries=cache_size,
+                stale_ttl=cache_stale_ttl)
+        if error_cache_ttl:
+            self.api_options["error_cache"] = ResponseCache(
+                ttl=error_cache_ttl, max_entries=self.error_cache_size)
+        self.stats_loop = LoopingCall(self.logStats)
+
+        # Rendered widget output, which is only cached along with the data
+        # it was made from
+        self.widget_cache = None
+        if cache_ttl and widget_cache_size:
+            self.widget_cache = ResponseCache(max_entries=widget_cache_size)
+
+        # Widgets are executed by threads shared between the connections,
+        # where cheap ones are preferred, or else by threads per request
+        self.widget_scheduler = None
+        if widget_threads:
+            self.widget_scheduler = WidgetScheduler(
+                widget_threads, reserved=reserved_widget_threads,
+                cheap_threshold=cheap_widget_time)
+
+        # The open (admitted) connections
+        self.connections = set()
+        # Set once the factory stops accepting connections, so that kept
+        # alive connections are closed after their current request
+        self.draining = False
+
+        # Popular queries are refreshed in the background
+        self.warmer = None
+        self.warm_loop = None
+        if warm_top and cache_ttl:
+            self.warmer = CacheWarmer(
+                lambda: StatAPI("whois/warmer", self.base_url,
+                                **self.api_options),
+                top_n=warm_top, interval=warm_interval, budget=warm_budget)
+            self.warm_loop = LoopingCall(threads.deferToThread,
+                                         self.warmer.warm)
+
+    def startFactory(self):
+        """
+        Open the access log and start logging statistics and warming the
+        cache periodically.
+        """
+        if self.request_threads:
+            reactor.suggestThreadPoolSize(self.request_threads)
+        if self.access_log_path:
+            self.access_log_file = open(self.access_log_path, "a")
+        self.access_log.start()
+        self.stats_loop.start(self.stats_interval, now=False)
+        if self.warm_loop:
+            self.warm_loop.start(self.warmer.interval, now=False)
+
+    def stopFactory(self):
+        """
+        Stop the periodic tasks and close the access log.
+        """
+        for loop in self.stats_loop, self.warm_loop:
+            if loop and loop.running:
+                loop.stop()
+        self.access_log.stop()
+        if self.access_log_file is not None:
+            self.access_log_file.close()
+            self.access_log_file = None
+
+    def drain(self, timeout):
+        """
+        Close idle kept alive connections and return a Deferred that fires
+        once the others have finished their current request, or after
+        `timeout` seconds.
+
+        Connections that haven't sent their first request yet are left
+        open, since their client is most likely about to send it.
+        """
+        self.draining = True
+        for protocol in list(self.connections):
+            if protocol.completed and not protocol.busy:
+                protocol.transport.loseConnection()
+        end_time = time.time() + timeout
+
+        def check():
+            if not self.connections or time.time() >= end_time:
+                loop.stop()
+        loop = LoopingCall(check)
+        return loop.start(0.1)
+
+    def logStats(self):
+        """
+        Log the upstream request, retry and hedge counters, any circuits
+        that aren't closed, the cache counters and the widget queues and
+        costs.
+        """
+        stats = {}
+        policy = self.api_options.get("retry_policy")
+        if policy:
+            stats.update(policy.stats())
+        breaker = self.api_options.get("circuit_breaker")
+        if breaker:
+            for call, state in breaker.stats().items():
+                stats["circuit-" + call] = state
+        if stats:
+            log.msg("Upstream: " + " ".join(
+                "{0}={1}".format(k, stats[k]) for k in sorted(stats)))
+        cache = self.api_options.get("cache")
+        stats = cache.stats() if cache else None
+        if stats:
+            log.msg("Cache: " + " ".join(
+                "{0}={1}".format(k, stats[k]) for k in sorted(stats)))
+        if self.widget_scheduler:
+            stats = self.widget_scheduler.stats()
+            log.msg("Widgets: " + " ".join(
+                "{0}={1}".format(k, stats[k]) for k in sorted(stats)))
+
+
+class InheritedPortService(service.Service):
+    """
+    Service that accepts connections on a listening socket that was created
+    by another process, e.g. a supervisor that forks several workers.
+
+    Because the socket stays open in the other process, a replacement
+    service can take it over while this one is stopping. Stopping therefore
+    lets the open connections finish their current request (for up to
+    `drain_timeout` seconds) instead of dropping them.
+
+    If `ready_fd` is given, a byte is written to it once connections are
+    being accepted.
+    """
+    def __init__(self, fileno, family, factory, ready_fd=None,
+                 drain_timeout=30):
+        self.fileno = fileno
+        self.family = family
+        self.factory = factory
+        self.ready_fd = ready_fd
+        self.drain_timeout = drain_timeout
+        self.port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.port = reactor.adoptStreamPort(self.fileno, self.family,
+                                            self.factory)
+        if self.ready_fd is not None:
+            try:
+                os.write(self.ready_fd, "\0")
+                os.close(self.ready_fd)
+            except OSError:
+                pass  # nobody is waiting any more
+            self.ready_fd = None
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.port is None:
+            return None
+        deferred = maybeDeferred(self.port.stopListening)
+        deferred.addCallback(
+            lambda _: self.factory.drain(self.drain_timeout))
+        return deferred
 
 
 class StatTextLineParser(BaseParser):
     """
     BaseParser subclass that responds to input from whois clients.
+
+    A single instance is shared by all of the connections. optparse keeps
+    state on the parser while parsing and formatting help, so those are
+    serialized with a lock, and help and usage messages go to the output
+    callback that the current thread passed to parse_line().
     """
     whois_option_list = [
         make_option("-k", "--keep-alive", action="store_true",
                     help="use a persistent connection")
     ]
 
-    def __init__(self, protocol, *args, **kwargs):
-        self.protocol = protocol
+    def __init__(self, *args, **kwargs):
         BaseParser.__init__(self, *args, **kwargs)
         for option in self.whois_option_list:
             self.add_option(option)
+        self.lock = threading.RLock()
+        self.local = threading.local()
+
+    def parse_line(self, params, output):
+        """
+        Parse the params of an input line, sending any help or usage
+        messages to output(line).
+        """
+        self.local.output = output
+        if len(params) == 1 and not params[0].startswith("-"):
+            # Fast path for the most common query: a bare resource
+            return self.get_default_values(), params
+        with self.lock:
+            return self.parse_args(params)
+
+    def format_option_help(self, *args, **kwargs):
+        with self.lock:
+            return BaseParser.format_option_help(self, *args, **kwargs)
 
     def print_help(self, *args, **kwargs):
         for line in self.format_option_help().split("\n"):
-            self.protocol.queueLine(line)
+            self.local.output(line)
 
     def print_usage(self, *args, **kwargs):
         self.print_help()
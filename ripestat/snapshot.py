@@ -0,0 +1,382 @@
+"""
+Offline snapshots of data call responses, indexed by prefix.
+
+A snapshot is built from previously fetched responses and lets StatAPI answer
+lookups for any address or prefix from the response stored for the most
+specific covering prefix, without contacting the data API.
+
+The snapshot file consists of:
+
+    header      magic, sizes of the following sections, trie strides
+    calls       JSON list of the data call names in the snapshot
+    IPv4 trie   2 ** stride (child node, record number + 1) slots per node
+    IPv6 trie   likewise
+    records     (first entry, number of entries, prefix length,
+                covering record number + 1) per prefix
+    entries     (call number, payload offset, payload length) per response
+    payload     the serialized responses
+
+The tries are multibit radix tries with controlled prefix expansion: each
+node consumes `stride` bits of the address, and a prefix that ends inside a
+node is written to every slot it covers. They are walked directly in the
+memory-mapped file, so loading a snapshot is instantaneous and its pages are
+shared between processes.
+"""
+from optparse import OptionParser
+import mmap
+import socket
+import struct
+import sys
+
+from ripestat.api import json
+from ripestat.resources import (
+    InvalidResource, normalize_prefix, parse_address)
+
+
+MAGIC = b"RSSNAP2\0"
+HEADER = struct.Struct("!8sIIIIIII")
+SLOT = struct.Struct("!II")
+RECORD = struct.Struct("!IIII")
+ENTRY = struct.Struct("!III")
+
+# Bits consumed per trie node. IPv4 tables are dense enough for wide nodes;
+# IPv6 tables are sparse and would waste most of them.
+IPV4_STRIDE = 8
+IPV6_STRIDE = 4
+
+
+class SnapshotBuilder(object):
+    """
+    Collect data call responses and write them to a snapshot file.
+
+    Responses for calls about a prefix (e.g. geoloc, prefix-overview) are
+    stored under that prefix. An announced-prefixes response for an ASN adds
+    a prefix-overview response for each of its prefixes, using the holder
+    from an as-overview response for the same ASN if one was added.
+    """
+    def __init__(self):
+        # prefix => {call: response}
+        self.prefixes = {}
+        # prefix => list of announcing ASNs
+        self.origins = {}
+        # ASN => holder
+        self.holders = {}
+
+    def add_response(self, call, response):
+        """
+        Add a full (i.e. not just the 'data' part) data call response.
+        """
+        data = response["data"]
+        if call == "announced-prefixes":
+            asn = int(data["resource"].upper().lstrip("AS"))
+            for prefix in data["prefixes"]:
+                prefix = normalize_prefix(prefix["prefix"])
+                origins = self.origins.setdefault(prefix, [])
+                if asn not in origins:
+                    origins.append(asn)
+        elif call == "as-overview":
+            self.holders[int(data["resource"].upper().lstrip("AS"))] = \
+                data.get("holder") or ""
+        elif data.get("resource"):
+            try:
+                prefix = normalize_prefix(data["resource"])
+            except InvalidResource:
+                return
+            if "/" not in prefix:
+                # Store single addresses as host prefixes
+                prefix += "/128" if ":" in prefix else "/32"
+            self.prefixes.setdefault(prefix, {})[call] = response
+
+    def get_records(self):
+        """
+        Return a dict of prefix => {call: response} including synthesized
+        prefix-overview responses.
+        """
+        records = dict((prefix, dict(calls)) for prefix, calls in
+                       self.prefixes.items())
+        for prefix, origins in self.origins.items():
+            calls = records.setdefault(prefix, {})
+            if "prefix-overview" in calls:
+                continue
+            calls["prefix-overview"] = {
+                "version": "1.0",
+                "status": "ok",
+                "messages": [],
+                "data_call_name": "prefix-overview",
+                "data": {
+                    "resource": prefix,
+                    "announced": True,
+                    "block": None,
+                    "asns": [{"asn": asn, "holder": self.holders.get(asn, "")}
+                             for asn in origins],
+                },
+            }
+        return records
+
+    def write(self, path):
+        """
+        Build the trie and write the snapshot to `path`.
+        """
+        records = self.get_records()
+        calls = sorted(set(call for responses in records.values()
+                           for call in responses))
+        call_numbers = dict((call, number) for number, call in
+                            enumerate(calls))
+
+        # Parse the prefixes and find the nearest covering prefix of each
+        parsed = {}
+        for prefix in records:
+            address, length = prefix.split("/")
+            family, packed = parse_address(address)
+            parsed[prefix] = (family, address_to_int(packed), int(length))
+        by_length = sorted(records, key=lambda p: parsed[p][2])
+        numbers = dict((prefix, number) for number, prefix in
+                       enumerate(by_length))
+        networks = set(parsed.values())
+
+        tries = {
+            socket.AF_INET: Trie(32, IPV4_STRIDE),
+            socket.AF_INET6: Trie(128, IPV6_STRIDE),
+        }
+        record_rows = []
+        entry_rows = []
+        payloads = []
+        offset = 0
+        for prefix in by_length:
+            family, value, length = parsed[prefix]
+            bits = tries[family].bits
+            parent = 0
+            for parent_length in range(length - 1, -1, -1):
+                mask = ((1 << parent_length) - 1) << (bits - parent_length)
+                network = (family, value & mask, parent_length)
+                if network in networks:
+                    parent = numbers[network_prefix(network)] + 1
+                    break
+            tries[family].insert(value, length, len(record_rows) + 1)
+            record_rows.append((len(entry_rows), len(records[prefix]),
+                                length, parent))
+            for call in sorted(records[prefix]):
+                payload = json.dumps(records[prefix][call]).encode("utf-8")
+                entry_rows.append((call_numbers[call], offset, len(payload)))
+                payloads.append(payload)
+                offset += len(payload)
+
+        ipv4, ipv6 = tries[socket.AF_INET], tries[socket.AF_INET6]
+        calls_json = json.dumps(calls).encode("utf-8")
+        with open(path, "wb") as handle:
+            handle.write(HEADER.pack(
+                MAGIC, len(calls_json), ipv4.stride, ipv4.node_count,
+                ipv6.stride, ipv6.node_count, len(record_rows),
+                len(entry_rows)))
+            handle.write(calls_json)
+            for trie in ipv4, ipv6:
+                for child, record in zip(trie.children, trie.records):
+                    handle.write(SLOT.pack(child, record))
+            for row in record_rows:
+                handle.write(RECORD.pack(*row))
+            for row in entry_rows:
+                handle.write(ENTRY.pack(*row))
+            for payload in payloads:
+                handle.write(payload)
+
+
+class Trie(object):
+    """
+    A multibit trie under construction, stored as flat lists of slots.
+
+    Prefixes must be inserted from the least to the most specific.
+    """
+    def __init__(self, bits, stride):
+        self.bits = bits
+        self.stride = stride
+        self.slots = 1 << stride
+        self.node_count = 1
+        self.children = [0] * self.slots
+        self.records = [0] * self.slots
+
+    def insert(self, value, length, record):
+        """
+        Point all of the slots covered by a prefix to `record`.
+        """
+        stride = self.stride
+        depth = max(0, (length + stride - 1) // stride - 1)
+        node = 0
+        for level in range(depth):
+            index = node * self.slots + self.get_chunk(value, level)
+            if not self.children[index]:
+                self.children[index] = self.node_count
+                self.node_count += 1
+                self.children.extend([0] * self.slots)
+                self.records.extend([0] * self.slots)
+            node = self.children[index]
+        free_bits = stride * (depth + 1) - length
+        first = self.get_chunk(value, depth) & ~((1 << free_bits) - 1)
+        start = node * self.slots + first
+        for index in range(start, start + (1 << free_bits)):
+            self.records[index] = record
+
+    def get_chunk(self, value, level):
+        """
+        Return the bits of `value` that select a slot at the given level.
+        """
+        shift = self.bits - self.stride * (level + 1)
+        return (value >> shift) & (self.slots - 1)
+
+
+class Snapshot(object):
+    """
+    A memory-mapped snapshot file.
+
+    Usage:
+        snapshot = Snapshot("prefixes.snap")
+        api = StatAPI("my-script", snapshot=snapshot)
+        api.get_data("prefix-overview", {"resource": "193.0.6.139"})
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as handle:
+            self.data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, calls_size, ipv4_stride, ipv4_nodes, ipv6_stride, \
+            ipv6_nodes, record_count, entry_count = HEADER.unpack_from(
+                self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a ripestat snapshot".format(path))
+        offset = HEADER.size
+        self.calls = json.loads(
+            self.data[offset:offset + calls_size].decode("utf-8"))
+        self.call_numbers = dict((call, number) for number, call in
+                                 enumerate(self.calls))
+        offset += calls_size
+        # (bits, stride, offset) for each family
+        self.tries = {}
+        for family, bits, stride, nodes in (
+                (socket.AF_INET, 32, ipv4_stride, ipv4_nodes),
+                (socket.AF_INET6, 128, ipv6_stride, ipv6_nodes)):
+            self.tries[family] = (bits, stride, offset)
+            offset += nodes * (1 << stride) * SLOT.size
+        self.records_offset = offset
+        self.entries_offset = offset + record_count * RECORD.size
+        self.payload_offset = self.entries_offset + entry_count * ENTRY.size
+
+    def lookup(self, resource):
+        """
+        Return a list of record numbers for the prefixes covering the given
+        address or prefix, most specific first.
+        """
+        length = None
+        try:
+            if "/" in resource:
+                resource, length = normalize_prefix(resource).split("/")
+                length = int(length)
+            if ":" in resource:
+                family = socket.AF_INET6
+                high, low = struct.unpack("!QQ", socket.inet_pton(
+                    family, resource))
+                value = (high << 64) | low
+            else:
+                # inet_aton is much faster than parse_address()
+                family = socket.AF_INET
+                value = struct.unpack("!I", socket.inet_aton(resource))[0]
+        except (socket.error, ValueError):
+            raise InvalidResource("invalid IP address: " + resource)
+        bits, stride, offset = self.tries[family]
+        if length is None:
+            length = bits
+
+        data = self.data
+        unpack_from = SLOT.unpack_from
+        slots = 1 << stride
+        mask = slots - 1
+        shift = bits - stride
+        node = 0
+        record = 0
+        for _ in range(max(1, (length + stride - 1) // stride)):
+            child, found = unpack_from(data, offset + SLOT.size * (
+                node * slots + ((value >> shift) & mask)))
+            if found:
+                record = found
+            if not child:
+                break
+            node = child
+            shift -= stride
+
+        matches = []
+        while record:
+            _, _, record_length, parent = RECORD.unpack_from(
+                data, self.records_offset + (record - 1) * RECORD.size)
+            # Records more specific than a queried prefix don't cover it
+            if record_length <= length:
+                matches.append(record - 1)
+            record = parent
+        return matches
+
+    def get_response(self, call, resource):
+        """
+        Return the serialized response for a data call about the most
+        specific prefix covering `resource`, or None if there isn't one.
+        """
+        call_number = self.call_numbers.get(call)
+        if call_number is None:
+            return None
+        data = self.data
+        for record in self.lookup(resource):
+            first, count, _, _ = RECORD.unpack_from(
+                data, self.records_offset + record * RECORD.size)
+            for entry in range(first, first + count):
+                number, offset, length = ENTRY.unpack_from(
+                    data, self.entries_offset + entry * ENTRY.size)
+                if number == call_number:
+                    start = self.payload_offset + offset
+                    return data[start:start + length].decode("utf-8")
+        return None
+
+
+def address_to_int(packed):
+    """
+    Convert a packed IPv4 or IPv6 address to an integer.
+    """
+    value = 0
+    for byte in struct.unpack("!%dB" % len(packed), packed):
+        value = (value << 8) | byte
+    return value
+
+
+def network_prefix(network):
+    """
+    Convert a (family, integer address, length) tuple to a prefix string.
+    """
+    family, value, length = network
+    if family == socket.AF_INET:
+        packed = struct.pack("!I", value)
+    else:
+        packed = struct.pack("!QQ", value >> 64, value & (2 ** 64 - 1))
+    return "{0}/{1}".format(socket.inet_ntop(family, packed), length)
+
+
+def main(params):
+    """
+    Build a snapshot file from data call responses saved as JSON.
+
+    The responses must be complete (e.g. saved with `ripestat -m -d ...`) so
+    that their 'data_call_name' is known.
+    """
+    parser = OptionParser(usage="%prog -o OUTPUT RESPONSE.json...")
+    parser.add_option("-o", "--output", help="the snapshot file to write")
+    options, args = parser.parse_args(params)
+    if not options.output or not args:
+        parser.error("an output file and at least one response are required")
+
+    builder = SnapshotBuilder()
+    for path in args:
+        with open(path) as handle:
+            response = json.load(handle)
+        call = response.get("data_call_name")
+        if not call:
+            parser.error("{0} doesn't include a data_call_name".format(path))
+        builder.add_response(call, response)
+    builder.write(options.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,331 @@
+"""
+Policies for making requests to the data API more robust against slow or
+failing upstream servers.
+
+The classes in this module know nothing about HTTP; StatAPI decides which
+errors are worth retrying. Instances are thread-safe, so that a single policy
+can be shared between all of the StatAPI instances of a server.
+"""
+from collections import deque
+from Queue import Queue, Empty
+import logging
+import random
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+LOG = logging.getLogger(__name__)
+
+# resource.RUSAGE_THREAD only exists from Python 3.2, but Linux has
+# supported it for much longer
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD",
+                        1 if sys.platform.startswith("linux") else None)
+
+
+class LatencyTracker(object):
+    """
+    Keep a window of recent latencies per key (usually a data call name).
+    """
+    def __init__(self, window=100, min_samples=20):
+        self.window = window
+        # Percentiles are meaningless until this many samples are seen
+        self.min_samples = min_samples
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, key, latency):
+        """
+        Add a latency (in seconds) for the given key.
+        """
+        with self.lock:
+            samples = self.samples.get(key)
+            if samples is None:
+                samples = self.samples[key] = deque(maxlen=self.window)
+            samples.append(latency)
+
+    def percentile(self, key, percentile):
+        """
+        Return the given percentile (0-100) of the recorded latencies, or
+        None if there aren't enough samples.
+        """
+        with self.lock:
+            samples = sorted(self.samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        index = int(round((len(samples) - 1) * percentile / 100.0))
+        return samples[index]
+
+
+class RetryBudget(object):
+    """
+    Token bucket that limits retries and hedges to a fraction of the normal
+    request rate.
+
+    Every request deposits `ratio` tokens and every extra attempt withdraws a
+    whole token, so during an incident the extra load is capped at `ratio`
+    times the normal load (plus the initial `max_tokens`).
+    """
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        """
+        Credit the budget for a normal request.
+        """
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        Take a token for an extra attempt, returning False if the budget is
+        exhausted.
+        """
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """
+    Retry failed requests with jittered exponential backoff and optionally
+    hedge slow ones, within a shared RetryBudget.
+
+    Usage:
+        policy = RetryPolicy(max_retries=2, hedge_percentile=95)
+        policy.call(fetch, "routing-history", is_retryable, url)
+    """
+    def __init__(self, max_retries=2, backoff=0.1, max_backoff=2.0,
+                 hedge_percentile=None, budget=None, latencies=None):
+        self.max_retries = max_retries
+        # Base and cap of the backoff delay in seconds
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Send a duplicate request once a request takes longer than this
+        # percentile of recent latencies for the same key (None disables it)
+        self.hedge_percentile = hedge_percentile
+        self.budget = budget or RetryBudget()
+        self.latencies = latencies or LatencyTracker()
+
+        self.counts = {
+            "requests": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge-wins": 0,
+            "budget-exhausted": 0,
+        }
+        self.counts_lock = threading.Lock()
+
+    def count(self, name):
+        """
+        Increment one of the counters reported by stats().
+        """
+        with self.counts_lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        """
+        Return a copy of the request, retry and hedge counters.
+        """
+        with self.counts_lock:
+            return dict(self.counts)
+
+    def call(self, func, key, is_retryable, *args):
+        """
+        Return func(*args), retrying while is_retryable(exception) is true.
+        """
+        self.count("requests")
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return self.hedged_call(func, key, *args)
+            except Exception as exc:
+                if attempt >= self.max_retries or not is_retryable(exc):
+                    raise
+                if not self.budget.withdraw():
+                    self.count("budget-exhausted")
+                    raise
+                attempt += 1
+                self.count("retries")
+                delay = random.uniform(0, min(
+                    self.max_backoff, self.backoff * 2 ** attempt))
+                LOG.info("retrying %s in %.2fs after: %s", key, delay, exc)
+                time.sleep(delay)
+
+    def hedged_call(self, func, key, *args):
+        """
+        Return func(*args), racing it against a duplicate call if it is
+        slower than usual.
+        """
+        start = time.time()
+        hedge_delay = None
+        if self.hedge_percentile is not None:
+            hedge_delay = self.latencies.percentile(key, self.hedge_percentile)
+        if hedge_delay is None:
+            result = func(*args)
+            self.latencies.record(key, time.time() - start)
+            return result
+
+        results = Queue()
+
+        def attempt(hedge):
+            """
+            Put the outcome of a single call on the results queue.
+            """
+            try:
+                results.put((hedge, True, func(*args)))
+            except Exception:
+                results.put((hedge, False, sys.exc_info()[1]))
+
+        start_thread(attempt, False)
+        pending = 1
+        try:
+            outcome = results.get(timeout=hedge_delay)
+        except Empty:
+            if self.budget.withdraw():
+                self.count("hedges")
+                LOG.info("hedging %s after %.2fs", key, hedge_delay)
+                start_thread(attempt, True)
+                pending += 1
+            else:
+                self.count("budget-exhausted")
+            outcome = results.get()
+            pending -= 1
+            # Only give up if every attempt has failed
+            if not outcome[1] and pending:
+                outcome = results.get()
+        hedge, success, value = outcome
+        self.latencies.record(key, time.time() - start)
+        if hedge and success:
+            self.count("hedge-wins")
+        if not success:
+            raise value
+        return value
+
+
+class Circuit(object):
+    """
+    The state of a single circuit in a CircuitBreaker.
+    """
+    __slots__ = "state", "failures", "opened_at"
+
+    def __init__(self):
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast on keys (usually data call names) whose requests keep failing
+    or being slow.
+
+    A circuit opens after `max_failures` consecutive failures. While it is
+    open, allow() returns False. After `reset_timeout` seconds a single probe
+    request is allowed through (half-open): it closes the circuit if it
+    succeeds and opens it again if it fails.
+
+    Usage:
+        if not breaker.allow(key):
+            raise SomeError()
+        ...
+        breaker.record(key, latency, failed)
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, max_failures=5, reset_timeout=30, slow_threshold=None):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        # Successful requests slower than this many seconds count as failures
+        self.slow_threshold = slow_threshold
+        # Only circuits that have seen failures are kept
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        """
+        Return True if a request for the given key may be sent upstream.
+        """
+        with self.lock:
+            circuit = self.circuits.get(key)
+            if circuit is None or circuit.state == self.CLOSED:
+                return True
+            if circuit.state == self.OPEN and \
+                    time.time() - circuit.opened_at >= self.reset_timeout:
+                # The caller becomes the probe
+                circuit.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record(self, key, latency, failed=False):
+        """
+        Record the outcome of a request that was allowed by allow().
+        """
+        if self.slow_threshold is not None and latency > self.slow_threshold:
+            failed = True
+        with self.lock:
+            if not failed:
+                self.circuits.pop(key, None)
+                return
+            circuit = self.circuits.get(key)
+            if circuit is None:
+                circuit = self.circuits[key] = Circuit()
+            circuit.failures += 1
+            if circuit.state == self.HALF_OPEN or \
+                    circuit.failures >= self.max_failures:
+                if circuit.state != self.OPEN:
+                    LOG.warning("circuit for %s is open", key)
+                circuit.state = self.OPEN
+                circuit.opened_at = time.time()
+
+    def abandon(self, key):
+        """
+        Forget about a request that was allowed but never reached upstream,
+        so that another request can probe a half-open circuit.
+        """
+        with self.lock:
+            circuit = self.circuits.get(key)
+            if circuit is not None and circuit.state == self.HALF_OPEN:
+                circuit.state = self.OPEN
+
+    def stats(self):
+        """
+        Return a dict of key => state for every circuit that isn't healthy.
+        """
+        with self.lock:
+            return dict((key, circuit.state) for key, circuit in
+                        self.circuits.items())
+
+
+def start_thread(target, *args):
+    """
+    Run target(*args) in a daemon thread.
+    """
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def thread_cpu_time():
+    """
+    Return the CPU time in seconds used by the current thread, or 0 if it
+    can't be measured.
+    """
+    if resource is None or RUSAGE_THREAD is None:
+        return 0.0
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
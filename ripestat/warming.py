@@ -0,0 +1,97 @@
+"""
+Background refreshing of the cached responses for popular queries.
+"""
+import logging
+import threading
+
+from ripestat.api import RequestMemo
+from ripestat.core import StatCore, StatQuery
+
+
+LOG = logging.getLogger(__name__)
+
+
+class CacheWarmer(object):
+    """
+    Track how often each (resource, widgets) combination is queried and
+    periodically re-run the most popular ones, so that their cache entries
+    are refreshed before they expire.
+
+    `api_factory` is called with no arguments at the start of each cycle and
+    must return a StatAPI that uses the shared cache.
+    """
+    # Counts are multiplied by this at the end of each cycle, so that
+    # resources that are no longer popular drop out
+    decay = 0.5
+    # Maximum number of distinct queries to keep counts for
+    max_tracked = 10000
+
+    def __init__(self, api_factory, top_n=20, interval=60, budget=100):
+        self.api_factory = api_factory
+        self.top_n = top_n
+        # Seconds between cycles
+        self.interval = interval
+        # Maximum number of upstream requests per cycle
+        self.budget = budget
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, query, widget_names):
+        """
+        Count a widget query.
+        """
+        if not query.get("resource"):
+            return
+        key = (query.cache_key, tuple(widget_names))
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if len(self.counts) > self.max_tracked:
+                self.prune(self.max_tracked // 2)
+
+    def prune(self, size):
+        """
+        Drop all but the `size` most popular queries. The lock must be held.
+        """
+        keep = sorted(self.counts, key=self.counts.get, reverse=True)[:size]
+        self.counts = dict((key, self.counts[key]) for key in keep)
+
+    def get_top(self):
+        """
+        Return the most popular queries as (query key, widget names) tuples.
+        """
+        with self.lock:
+            return sorted(self.counts, key=self.counts.get,
+                          reverse=True)[:self.top_n]
+
+    def warm(self):
+        """
+        Carry out a single warming cycle.
+
+        Only responses that would expire before the cycle after next are
+        fetched, and the cycle stops once the upstream budget is spent.
+        """
+        api = self.api_factory()
+        api.cache_min_ttl = self.interval * 2
+        # Enforced by the API before each request, since the widgets of a
+        # single query can make many
+        api.upstream_budget = self.budget
+        core = StatCore(lambda line: None, api)
+        warmed = 0
+        for query_items, widget_names in self.get_top():
+            if api.upstream_requests >= self.budget:
+                break
+            query = StatQuery(*["=".join(item) for item in query_items])
+            memo = RequestMemo(api)
+            for widget_name in widget_names:
+                core.exec_widget(widget_name, query, False, api=memo)
+            warmed += 1
+        LOG.info("warmed %d queries with %d upstream requests", warmed,
+                 api.upstream_requests)
+
+        with self.lock:
+            for key in list(self.counts):
+                count = self.counts[key] * self.decay
+                if count < 1:
+                    del self.counts[key]
+                else:
+                    self.counts[key] = count
@@ -1,3 +1,8 @@
+# Frame types for WhoisSerializer.iter_items
+RECORDS = 0
+LIST = 1
+
+
 class WhoisSerializer(object):
     """
     Simple serializer that outputs in to a pseudo whois format.
@@ -7,42 +12,93 @@ class WhoisSerializer(object):
         """
         Return a list of key, value pairs suitable for whois-style output.
         """
-        items = []
-        if isinstance(native, dict) or isinstance(native, list) and parent is \
-                None:
-            if isinstance(native, dict):
-                native = native.items()
-            for record in native:
-                if isinstance(record, (basestring, type(None))):
-                    if record:
-                        items.append("% " + record)
+        return list(self.iter_items(native, parent))
+
+    def iter_items(self, native, parent=None):
+        """
+        Yield key, value pairs (and comment strings) suitable for whois-style
+        output.
+
+        Nested dicts and lists are flattened to dotted keys, e.g.
+        'prefixes.0.timelines.1.starttime'. Elements of a list that produce
+        no items are not counted in the numbering.
+
+        An explicit stack is used instead of recursion. Scalars are emitted
+        straight from the loop over their container, and each key prefix is
+        built only once per container.
+        """
+        # Each frame is [RECORDS, iterator, parent key (if a string)] or
+        # [LIST, iterator, key prefix, items numbered so far, number of items
+        # emitted when the current element started (or None)]
+        stack = []
+        emitted = 0
+        value, key = native, parent
+        while True:
+            # Visit a container, or a scalar at the top level
+            if isinstance(value, dict) or isinstance(value, list) and key is \
+                    None:
+                if isinstance(value, dict):
+                    value = value.items()
+                if not isinstance(key, basestring):
+                    key = None
+                stack.append([RECORDS, iter(value), key])
+            elif isinstance(value, list):
+                stack.append([LIST, iter(value), key + "." if key else "", 0,
+                              None])
+            elif key:
+                emitted += 1
+                yield key, unicode(value).rstrip()
+
+            # Emit scalars until the next container is found
+            while stack:
+                frame = stack[-1]
+                if frame[0] == LIST:
+                    prefix = frame[2]
+                    if frame[4] is not None:
+                        # Only count the last container if it wasn't empty
+                        if emitted > frame[4]:
+                            frame[3] += 1
+                        frame[4] = None
+                    for value in frame[1]:
+                        key = prefix + str(frame[3])
+                        if isinstance(value, (dict, list)):
+                            frame[4] = emitted
+                            break
+                        frame[3] += 1
+                        emitted += 1
+                        if type(value) is not unicode:
+                            value = unicode(value)
+                        yield key, value.rstrip()
                     else:
-                        items.append("")
+                        stack.pop()
+                        continue
+                    break
                 else:
-                    key, value = record
-                    if isinstance(parent, basestring):
-                        key = ".".join((str(parent), key))
-                    items.extend(self.get_items(value, parent=key))
-        elif isinstance(native, list):
-            non_empty = 0
-            for item in native:
-                if parent:
-                    key = "{0}.{1}".format(parent, non_empty)
-                else:
-                    key = str(non_empty)
-                more_items = self.get_items(item, parent=key)
-                if more_items:
-                    items.extend(more_items)
-                    non_empty += 1
-        else:
-            if parent:
-                native = unicode(native).rstrip()
-                if parent:
-                    items = [(parent, native)]
-                else:
-                    items = [native]
-
-        return items
+                    parent = frame[2]
+                    for record in frame[1]:
+                        if isinstance(record, (basestring, type(None))):
+                            emitted += 1
+                            if record:
+                                yield "% " + record
+                            else:
+                                yield ""
+                            continue
+                        key, value = record
+                        if parent is not None:
+                            key = ".".join((parent, key))
+                        if isinstance(value, (dict, list)):
+                            break
+                        if key:
+                            emitted += 1
+                            if type(value) is not unicode:
+                                value = unicode(value)
+                            yield key, value.rstrip()
+                    else:
+                        stack.pop()
+                        continue
+                    break
+            else:
+                return
 
     def dumps(self, native, plugin=None, min_key_width=None, **kwargs):
         """
@@ -54,12 +110,14 @@ class WhoisSerializer(object):
         elif plugin:
             native[plugin] = ""
 
-        parts = self.get_items(native)
-
+        parts = []
         key_width = 0
-        for part in parts:
+        for part in self.iter_items(native):
+            parts.append(part)
             if not isinstance(part, basestring):
-                key_width = max(key_width, len(part[0] or ""))
+                key_length = len(part[0] or "")
+                if key_length > key_width:
+                    key_width = key_length
         key_width += 4
         if min_key_width:
             key_width = max(min_key_width, key_width)
@@ -3,9 +3,13 @@ Module containing functions for loading widgets, as well as some basic common
 functionality shared by various widgets.
 """
 from functools import partial
+from itertools import chain, islice
+import heapq
 import os.path
 import pkgutil
 
+from ripestat.parser import UserError
+
 
 # This structure will be replaced with dynamic interaction with the server.
 GROUPS = {
@@ -108,27 +112,102 @@ def default_widget(widget_name, api, query):
     return data, items
 
 
-def simple_table(rows):
+def get_paging(query):
+    """
+    Split the limit= and offset= parameters off a query.
+
+    Returns a tuple of (limit, offset, remaining query). The limit is None if
+    it wasn't given. The remaining query can be passed on to the data API,
+    so that parameters such as starttime and endtime still apply.
+    """
+    paging = {}
+    for param in "limit", "offset":
+        value = query.get(param)
+        if value is None:
+            paging[param] = None
+        elif value.isdigit():
+            paging[param] = int(value)
+        else:
+            raise UserError("{0} must be a non-negative integer".format(
+                param))
+    data_query = dict((key, value) for key, value in query.items() if key
+                      not in ("limit", "offset"))
+    return paging["limit"], paging["offset"] or 0, data_query
+
+
+def select_page(items, limit, offset, key, reverse=False):
+    """
+    Return a list of the items that would be at [offset:offset + limit] after
+    sorting.
+
+    Only a heap of offset + limit items is kept if a limit is given, rather
+    than sorting everything.
+    """
+    if limit is None:
+        return sorted(items, key=key, reverse=reverse)[offset:]
+    select = heapq.nlargest if reverse else heapq.nsmallest
+    return select(offset + limit, items, key=key)[offset:]
+
+
+def page_note(shown, offset, total, noun):
+    """
+    Return a comment line describing a partial listing, or None if all of
+    the items are shown.
+    """
+    if shown == total:
+        return None
+    if not shown:
+        return "No {0} from offset {1}; there are {2} {0}".format(
+            noun, offset, total)
+    return "Showing {0} {1}-{2} of {3}; use offset= and limit= to see " \
+        "others".format(noun, offset + 1, offset + shown, total)
+
+
+def simple_table(rows, lookahead=None, max_width=None):
     """
     For each sequence in 'rows', yield a string containing properly spaced
-    columns.
+    columns. Other rows (e.g. strings) are yielded unchanged.
+
+    By default all of the rows are read first, so that each column is exactly
+    as wide as its widest cell. If `lookahead` is given, the widths are
+    taken from that many rows and the rest are streamed as they are read
+    (cells that are wider than their column push the following columns out).
+    `max_width` limits how far any column is padded.
     """
+    rows = iter(rows)
+    if lookahead is None:
+        buffered = list(rows)
+    else:
+        buffered = list(islice(rows, lookahead))
+
     # Calculate the column widths
-    widths = None
-    rows = list(rows)
-    for row in rows:
+    widths = []
+    for row in buffered:
         if not isinstance(row, (list, tuple)):
             continue
-        if widths is None:
-            widths = [len(col) for col in row]
-        else:
-            widths = [max(width, len(col)) for (width, col) in
-                      zip(widths, row)]
+        for index, col in enumerate(row):
+            if index == len(widths):
+                widths.append(len(col))
+            elif len(col) > widths[index]:
+                widths[index] = len(col)
+    if max_width is not None:
+        for index, width in enumerate(widths):
+            if width > max_width:
+                widths[index] = max_width
 
     # Yield the rows
-    for row in rows:
+    for row in chain(buffered, rows):
         if isinstance(row, (list, tuple)):
-            line = "  ".join(p.ljust(width) for (width, p) in zip(widths, row))
-            yield line
+            yield format_row(row, widths)
         else:
             yield row
+
+
+def format_row(row, widths):
+    """
+    Join the cells of a table row, padding all but the last one to the given
+    column widths.
+    """
+    last = len(row) - 1
+    return "  ".join(col if index == last or index >= len(widths) else
+                     col.ljust(widths[index]) for index, col in enumerate(row))
@@ -1,9 +1,18 @@
+from . import get_paging, page_note, select_page
+
+
 def widget(api, query):
-    data = api.get_data("announced-prefixes", query, version=1)
+    limit, offset, data_query = get_paging(query)
+    data = api.get_data("announced-prefixes", data_query, version=1)
 
     result = [
         ("announced-prefixes", data["resource"]),
     ]
-    for prefix in sorted(data["prefixes"], key=lambda x: x["prefix"]):
+    prefixes = select_page(data["prefixes"], limit, offset,
+                           key=lambda x: x["prefix"])
+    for prefix in prefixes:
         result.append(("prefix", prefix["prefix"]))
+    note = page_note(len(prefixes), offset, len(data["prefixes"]), "prefixes")
+    if note:
+        result.append(note)
     return data, result
@@ -8,21 +8,23 @@ def widget(api, query):
         ("geoloc", data["resource"]),
     ]
 
-    loc_rows = []
-    for location in sorted(data["locations"], key=lambda l:
-                           l["covered_percentage"], reverse=True):
-        loc_row = []
-        percent = location["covered_percentage"]
-        if percent >= 0.1:
-            loc_row.append("%4.1f%%" % percent)
-        else:
-            loc_row.append("<0.1%")
-        if location["city"] and location["country"]:
-            loc_row.append("%s, %s" % (location["city"], location["country"]))
-        elif location["city"] or location["country"]:
-            loc_row.append((location["city"] or location["country"]))
-        loc_rows.append(loc_row)
-    for loc_str in simple_table(loc_rows):
+    locations = sorted(data["locations"], key=lambda l:
+                       l["covered_percentage"], reverse=True)
+    for loc_str in simple_table(get_location_row(l) for l in locations):
         result.append(("location", loc_str))
 
     return data, result
+
+
+def get_location_row(location):
+    loc_row = []
+    percent = location["covered_percentage"]
+    if percent >= 0.1:
+        loc_row.append("%4.1f%%" % percent)
+    else:
+        loc_row.append("<0.1%")
+    if location["city"] and location["country"]:
+        loc_row.append("%s, %s" % (location["city"], location["country"]))
+    elif location["city"] or location["country"]:
+        loc_row.append((location["city"] or location["country"]))
+    return loc_row
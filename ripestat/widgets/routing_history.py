@@ -1,22 +1,57 @@
-from . import simple_table
+from itertools import islice
+import heapq
+
+from . import get_paging, page_note, simple_table
+
+
+# Large route tables are streamed with column widths taken from this many rows
+LOOKAHEAD = 1000
 
 
 def widget(api, query):
-    data = api.get_data("routing-history", query, version=2)
+    limit, offset, data_query = get_paging(query)
+    data = api.get_data("routing-history", data_query, version=2)
 
     result = [
         ("routing-history", data["resource"])
     ]
 
-    routes = []
-    for prefixes_for_origin in data["by_origin"]:
-        origin = prefixes_for_origin["origin"]
-        for prefix in sorted(prefixes_for_origin["prefixes"], key=lambda x:
-                             x["timelines"][-1]["endtime"], reverse=True):
-            timeline = prefix["timelines"][-1]
-            routes.append((origin, prefix["prefix"], timeline["starttime"],
-                          "to", timeline["endtime"]))
-    for value in simple_table(routes):
+    total = sum(len(p["prefixes"]) for p in data["by_origin"])
+    if limit is None:
+        shown = max(0, total - offset)
+        stop = None
+    else:
+        shown = max(0, min(limit, total - offset))
+        stop = offset + limit
+    routes = islice(get_routes(data["by_origin"], stop), offset, stop)
+    for value in simple_table(routes, lookahead=LOOKAHEAD):
         result.append(("route", value))
+    note = page_note(shown, offset, total, "routes")
+    if note:
+        result.append(note)
 
     return data, result
+
+
+def get_routes(by_origin, stop=None):
+    """
+    Yield a table row for each route, grouped by origin, most recent first.
+
+    If `stop` is given, only the first `stop` rows need to be correct.
+    """
+    get_endtime = lambda x: x["timelines"][-1]["endtime"]
+    count = 0
+    for prefixes_for_origin in by_origin:
+        origin = prefixes_for_origin["origin"]
+        prefixes = prefixes_for_origin["prefixes"]
+        if stop is None:
+            prefixes = sorted(prefixes, key=get_endtime, reverse=True)
+        else:
+            # Only the most recent routes of each origin can make the page
+            prefixes = heapq.nlargest(max(0, stop - count), prefixes,
+                                      key=get_endtime)
+        for prefix in prefixes:
+            timeline = prefix["timelines"][-1]
+            count += 1
+            yield (origin, prefix["prefix"], timeline["starttime"], "to",
+                   timeline["endtime"])
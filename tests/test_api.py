@@ -0,0 +1,84 @@
+"""
+Tests for the caching of data API responses.
+"""
+import io
+import json
+import unittest
+
+from ripestat.api import CachedResponse, StatAPI
+from ripestat.cache import CompressedResponseCache, ResponseCache
+
+
+class EchoAPI(StatAPI):
+    """
+    StatAPI that answers every request locally with the address in its
+    X-Forwarded-For header.
+    """
+    def __init__(self, *args, **kwargs):
+        StatAPI.__init__(self, *args, **kwargs)
+        self.requests = 0
+
+    def open(self, url, *args, **kwargs):
+        self.requests += 1
+        address = dict(self.headers or []).get("X-Forwarded-For")
+        return io.BytesIO(json.dumps({
+            "data": {"ip": address},
+            "messages": [],
+            "version": "1.0",
+            "status": "ok",
+        }).encode("utf-8"))
+
+
+class ResponseCacheKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(ttl=60)
+
+    def make_api(self, address):
+        return EchoAPI("test", headers=[("X-Forwarded-For", address)],
+                       cache=self.cache)
+
+    def test_caller_calls_per_client(self):
+        first = self.make_api("192.0.2.1")
+        second = self.make_api("192.0.2.2")
+        self.assertEqual(first.get_data("whats-my-ip")["ip"], "192.0.2.1")
+        self.assertEqual(second.get_data("whats-my-ip")["ip"], "192.0.2.2")
+        self.assertEqual((first.requests, second.requests), (1, 1))
+        self.assertEqual(len(self.cache.entries), 2)
+        self.assertEqual(first.get_data("whats-my-ip")["ip"], "192.0.2.1")
+        self.assertEqual(first.requests, 1)
+
+    def test_other_calls_shared(self):
+        first = self.make_api("192.0.2.1")
+        second = self.make_api("192.0.2.2")
+        first.get_data("geoloc", {"resource": "193.0.0.0/21"})
+        second.get_data("geoloc", {"resource": "193.0.0.0/21"})
+        self.assertEqual((first.requests, second.requests), (1, 0))
+
+    def test_logged_in_not_cached(self):
+        api = EchoAPI("test", token="crowd_session", cache=self.cache)
+        api.get_data("geoloc", {"resource": "193.0.0.0/21"})
+        api.get_data("geoloc", {"resource": "193.0.0.0/21"})
+        self.assertEqual(api.requests, 2)
+        self.assertEqual(len(self.cache.entries), 0)
+
+
+class CachedResponseTest(unittest.TestCase):
+
+    def test_stored(self):
+        api = EchoAPI("test", cache=ResponseCache(ttl=60))
+        response = api.get_response("geoloc/data.json", {"resource": "x"})
+        self.assertTrue(isinstance(response, CachedResponse))
+
+    def test_not_stored(self):
+        # Too small to hold the response
+        api = EchoAPI("test", cache=CompressedResponseCache(ttl=60,
+                                                            max_bytes=10))
+        response = api.get_response("geoloc/data.json", {"resource": "x"})
+        self.assertFalse(isinstance(response, CachedResponse))
+        self.assertEqual(api.get_data_expiry("geoloc", {"resource": "x"}),
+                         None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Tests for the response cache backends.
+
+The MemcachedCache tests need a memcached server, which is looked for at
+RIPESTAT_TEST_MEMCACHED (HOST:PORT, 127.0.0.1:11211 by default); they are
+skipped if it can't be reached.
+"""
+import os
+import socket
+import time
+import unittest
+
+from ripestat.cache import (CacheBackend, CompressedResponseCache,
+                            MemcachedCache, ResponseCache)
+
+
+MEMCACHED = os.environ.get("RIPESTAT_TEST_MEMCACHED", "127.0.0.1:11211")
+
+
+def memcached_available():
+    """
+    Return True if the test memcached server accepts connections.
+    """
+    host, _, port = MEMCACHED.rpartition(":")
+    try:
+        socket.create_connection((host.strip("[]"), int(port)), 0.5).close()
+    except socket.error:
+        return False
+    return True
+
+
+def unused_port():
+    """
+    Return a local port that nothing listens on.
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class CacheBackendTest(unittest.TestCase):
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, CacheBackend)
+
+    def test_stale_window(self):
+        cache = ResponseCache(ttl=0.05, stale_ttl=10)
+        cache.set("key", u"body")
+        time.sleep(0.1)
+        self.assertEqual(cache.get("key"), None)
+        self.assertEqual(cache.read("key")[1], u"body")
+
+    def test_too_large(self):
+        cache = CompressedResponseCache(max_bytes=100)
+        self.assertTrue(cache.set("small", u"body"))
+        self.assertFalse(cache.set("large", os.urandom(200).encode("hex")))
+        self.assertEqual(cache.read("large"), None)
+        self.assertEqual(cache.read("small")[1], u"body")
+
+
+@unittest.skipUnless(memcached_available(),
+                     "no memcached server at " + MEMCACHED)
+class MemcachedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MemcachedCache([MEMCACHED], ttl=60)
+        # Keys that earlier runs can't have left behind
+        self.prefix = "test-{0}-".format(time.time())
+
+    def test_round_trip(self):
+        body = u"{\"data\": \"\u00e9\"}"
+        self.assertTrue(self.cache.set(self.prefix + "small", body))
+        self.assertEqual(self.cache.get(self.prefix + "small"), body)
+
+    def test_compressed(self):
+        body = u"x" * (self.cache.compress_threshold * 4)
+        self.cache.set(self.prefix + "large", body)
+        self.assertEqual(self.cache.get(self.prefix + "large"), body)
+
+    def test_expiry(self):
+        self.cache.set(self.prefix + "short", u"body", ttl=0.05)
+        expires = self.cache.expires(self.prefix + "short")
+        self.assertTrue(expires <= time.time() + 0.05)
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get(self.prefix + "short"), None)
+
+    def test_miss(self):
+        self.assertEqual(self.cache.read(self.prefix + "missing"), None)
+
+
+class MemcachedDownTest(unittest.TestCase):
+
+    def test_down_server_is_skipped(self):
+        cache = MemcachedCache(["127.0.0.1:{0}".format(unused_port())])
+        server = cache.servers[0]
+        self.assertEqual(cache.get("key"), None)
+        self.assertTrue(server.is_down())
+
+        def fail(*args):
+            raise AssertionError("a down server was contacted")
+        server.call = fail
+        self.assertEqual(cache.get("key"), None)
+        self.assertFalse(cache.set("key", u"body"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests for the widget scheduler.
+"""
+import threading
+import time
+import unittest
+
+from ripestat.scheduling import WidgetScheduler
+
+
+class WidgetSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ran = []
+
+    def make_scheduler(self, size, reserved):
+        """
+        Return a scheduler that has learned that "slow" is expensive and
+        "fast" is cheap.
+        """
+        scheduler = WidgetScheduler(size=size, reserved=reserved,
+                                    cheap_threshold=0.5)
+        scheduler.widget_costs.record("slow", 2.0)
+        scheduler.widget_costs.record("fast", 0.01)
+        return scheduler
+
+    def block(self, scheduler, name):
+        """
+        Occupy a thread with a run of `name` until the returned event is
+        set.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def run():
+            started.set()
+            release.wait(5)
+        scheduler.submit(name, None, run)
+        self.assertTrue(started.wait(5))
+        return release
+
+    def record(self, name):
+        """
+        Return a function that notes that `name` ran, and on which thread.
+        """
+        def run():
+            self.ran.append((name, threading.current_thread()))
+            return name
+        return run
+
+    def test_cheap_first(self):
+        scheduler = self.make_scheduler(size=1, reserved=0)
+        release = self.block(scheduler, "fast")
+        slow = scheduler.submit("slow", None, self.record("slow"))
+        fast = scheduler.submit("fast", None, self.record("fast"))
+        release.set()
+        self.assertTrue(slow.done.wait(5))
+        self.assertTrue(fast.done.wait(5))
+        self.assertEqual([name for name, _ in self.ran], ["fast", "slow"])
+
+    def test_aging(self):
+        scheduler = self.make_scheduler(size=1, reserved=0)
+        scheduler.max_wait = 0
+        release = self.block(scheduler, "fast")
+        slow = scheduler.submit("slow", None, self.record("slow"))
+        fast = scheduler.submit("fast", None, self.record("fast"))
+        release.set()
+        self.assertTrue(slow.done.wait(5))
+        self.assertTrue(fast.done.wait(5))
+        self.assertEqual([name for name, _ in self.ran], ["slow", "fast"])
+
+    def test_reserved_threads(self):
+        scheduler = self.make_scheduler(size=3, reserved=2)
+        scheduler.max_wait = 0
+        release = self.block(scheduler, "slow")
+        # The only unreserved thread is busy, so expensive jobs wait even
+        # though the reserved threads are idle...
+        slow = [scheduler.submit("slow", None, self.record("slow"))
+                for _ in range(3)]
+        time.sleep(0.1)
+        self.assertFalse(any(job.done.is_set() for job in slow))
+        # ...while cheap jobs still run
+        fast = scheduler.submit("fast", None, self.record("fast"))
+        self.assertTrue(fast.done.wait(5))
+        self.assertEqual(fast.result, "fast")
+        release.set()
+        for job in slow:
+            self.assertTrue(job.done.wait(5))
+        reserved = set(scheduler.threads[:scheduler.reserved])
+        self.assertFalse([name for name, thread in self.ran
+                          if name == "slow" and thread in reserved])
+
+    def test_all_reserved(self):
+        scheduler = self.make_scheduler(size=8, reserved=8)
+        self.assertEqual(scheduler.reserved, 7)
+        slow = scheduler.submit("slow", None, self.record("slow"))
+        self.assertTrue(slow.done.wait(5))
+        self.assertEqual(slow.result, "slow")
+
+    def test_expired(self):
+        scheduler = self.make_scheduler(size=1, reserved=0)
+        release = self.block(scheduler, "fast")
+        job = scheduler.submit("fast", time.time() + 0.05,
+                               self.record("fast"))
+        time.sleep(0.1)
+        release.set()
+        self.assertTrue(job.done.wait(5))
+        self.assertTrue(job.timed_out)
+        self.assertEqual(self.ran, [])
+
+    def test_full_queue(self):
+        scheduler = self.make_scheduler(size=1, reserved=0)
+        scheduler.max_queued = 1
+        release = self.block(scheduler, "fast")
+        queued = scheduler.submit("fast", None, self.record("fast"))
+        rejected = scheduler.submit("fast", None, self.record("fast"))
+        self.assertTrue(rejected.timed_out)
+        self.assertEqual(scheduler.stats()["rejected"], 1)
+        release.set()
+        self.assertTrue(queued.done.wait(5))
+        self.assertFalse(queued.timed_out)
+
+
+if __name__ == "__main__":
+    unittest.main()